@@ -0,0 +1,273 @@
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import contextlib
+import io
+import numpy as np
+import torch
+from torch.autograd.graph import saved_tensors_hooks
+
+import transformer
+from transformer import MultiHeadAttention, Trainer, MTDataset, Config, BOS_ID, EOS_ID, PAD_ID
+
+# model sizes benchmarked, larger ones are given by --configs
+CONFIGS = {
+    'tiny': {'dim': 64, 'n_layers': 2, 'n_heads': 4, 'n_words': 32, 'batch_size': 32},
+    'small': {'dim': 256, 'n_layers': 4, 'n_heads': 8, 'n_words': 64, 'batch_size': 32},
+    'base': {'dim': 512, 'n_layers': 6, 'n_heads': 8, 'n_words': 64, 'batch_size': 32},
+}
+VOCAB_SIZE = 8000
+TRAIN_SENTENCES = 20000
+VALID_SENTENCES = 200
+
+def measure(fn, repeat, warmup=2):
+    """
+    returns median seconds of fn
+    """
+    for _ in range(warmup):
+        fn()
+
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+
+    return float(np.median(times))
+
+def write_sentences(path, n_sentences, n_words, rng):
+    """
+    synthetic id text file, sentences start with BOS_ID and end with EOS_ID
+    """
+    lengths = rng.integers(3, n_words - 1, size=n_sentences)
+    with open(path, 'w') as f:
+        for length in lengths:
+            ids = rng.integers(PAD_ID + 1, VOCAB_SIZE, size=length)
+            f.write(' '.join(map(str, [BOS_ID, *ids, EOS_ID])) + '\n')
+
+def get_config(dataroot, params, options):
+    args = ['--cpu', '--dataroot', dataroot, '--src', 'src', '--tgt', 'tgt', '--vocab_size', str(VOCAB_SIZE)]
+    for key, value in params.items():
+        args += [f'--{key}', str(value)]
+
+    args = transformer.get_parser().parse_args(args + options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return Config(args)
+
+def get_batch(config, rng):
+    lengths = rng.integers(3, config.n_words - 1, size=config.batch_size)
+    x = torch.full((config.batch_size, config.n_words), PAD_ID, dtype=torch.long)
+    for i, length in enumerate(lengths):
+        x[i, 0] = BOS_ID
+        x[i, 1:length+1] = torch.from_numpy(rng.integers(PAD_ID + 1, VOCAB_SIZE, size=length))
+        x[i, length+1] = EOS_ID
+
+    return x[:, :lengths.max() + 2]
+
+def bench_attention(config, repeat):
+    results = {}
+    x = torch.randn(config.batch_size, config.n_words, config.dim)
+    mask = torch.zeros(config.batch_size, config.n_words, dtype=torch.bool)
+    mask[:, config.n_words * 3 // 4:] = True
+
+    for impl in MultiHeadAttention.IMPLS:
+        attention = MultiHeadAttention(config.n_heads, config.dim, config.dropout, impl=impl)
+
+        def forward():
+            with torch.no_grad():
+                attention(x, x, mask)
+
+        def forward_backward():
+            attention(x, x, mask).sum().backward()
+
+        results[f'attention/{impl}/forward_ms'] = measure(forward, repeat) * 1000
+        results[f'attention/{impl}/forward_backward_ms'] = measure(forward_backward, repeat) * 1000
+
+    return results
+
+def bench_trainer(config, repeat, rng):
+    results = {}
+    trainer = Trainer(config)
+    x, y = get_batch(config, rng), get_batch(config, rng)
+    n_tokens = (y != PAD_ID).sum().item()
+
+    step_time = measure(lambda: trainer.step(x, y), repeat)
+    results['trainer/step_ms'] = step_time * 1000
+    results['trainer/step_tokens_per_sec'] = n_tokens / step_time
+
+    for beam_size in [1, 4]:
+        trainer.config.beam_size = beam_size
+        generate_time = measure(lambda: trainer.translate(x), repeat)
+        results[f'generate/beam{beam_size}/batch_ms'] = generate_time * 1000
+        results[f'generate/beam{beam_size}/sentences_per_sec'] = x.size(0) / generate_time
+
+        generate_time = measure(lambda: trainer.translate(x[:1]), repeat)
+        results[f'generate/beam{beam_size}/sentence_ms'] = generate_time * 1000
+    trainer.config.beam_size = 1
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results['evaluate/valid_ms'] = measure(lambda: trainer.evaluate(data_type='valid'), 1, warmup=1) * 1000
+
+    return results
+
+def get_saved_bytes(trainer, x, y):
+    """
+    bytes of tensors kept for backward by forward of a training step
+    """
+    storages = {}
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        storages[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    trainer.encoder.train()
+    trainer.decoder.train()
+    with saved_tensors_hooks(pack, lambda tensor: tensor):
+        enc_output = trainer.encoder(x)
+        scores = trainer.decoder.predict(trainer.decoder(y[:, :-1], enc_output, x == PAD_ID, True))
+    del scores
+
+    return sum(storages.values())
+
+def bench_checkpointing(config, repeat, rng):
+    """
+    memory and speed of training step by the number of layers recomputed together
+    """
+    results = {}
+    trainer = Trainer(config)
+    x, y = get_batch(config, rng), get_batch(config, rng)
+    n_tokens = (y != PAD_ID).sum().item()
+
+    for checkpoint_layers in sorted({0, 1, 2, config.n_layers}):
+        trainer.encoder.checkpoint_layers = checkpoint_layers
+        trainer.decoder.checkpoint_layers = checkpoint_layers
+
+        step_time = measure(lambda: trainer.step(x, y), repeat)
+        results[f'checkpoint/layers{checkpoint_layers}/saved_mb'] = get_saved_bytes(trainer, x, y) / 2**20
+        results[f'checkpoint/layers{checkpoint_layers}/step_ms'] = step_time * 1000
+        results[f'checkpoint/layers{checkpoint_layers}/step_tokens_per_sec'] = n_tokens / step_time
+
+    return results
+
+def bench_dataset(config, repeat):
+    results = {}
+    results['dataset/text_load_ms'] = measure(lambda: MTDataset(config, 'train'), repeat, warmup=1) * 1000
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        results['dataset/binarize_ms'] = measure(lambda: MTDataset.binarize(config), 1, warmup=0) * 1000
+    results['dataset/binary_load_ms'] = measure(lambda: MTDataset(config, 'train'), repeat, warmup=1) * 1000
+
+    data = MTDataset(config, 'train')
+    dataloader = torch.utils.data.DataLoader(data, batch_size=config.batch_size, shuffle=True, collate_fn=MTDataset.collate)
+    iterate_time = measure(lambda: sum(1 for _ in dataloader), 1, warmup=0)
+    results['dataset/iterate_sentences_per_sec'] = len(data) / iterate_time
+
+    return results
+
+def run_benchmarks(names, repeat, options):
+    torch.manual_seed(0)
+    rng = np.random.default_rng(0)
+
+    results = {}
+    for name in names:
+        params = CONFIGS[name]
+        with tempfile.TemporaryDirectory() as dataroot:
+            for lang in ['src', 'tgt']:
+                write_sentences(f'{dataroot}/train.{lang}', TRAIN_SENTENCES, params['n_words'], np.random.default_rng(1))
+                write_sentences(f'{dataroot}/valid.{lang}', VALID_SENTENCES, params['n_words'], np.random.default_rng(2))
+
+            config = get_config(dataroot, params, options)
+            print(f'benchmark {name}: {params}', file=sys.stderr)
+
+            config_results = {}
+            config_results.update(bench_attention(config, repeat))
+            config_results.update(bench_trainer(config, repeat, rng))
+            config_results.update(bench_checkpointing(config, repeat, rng))
+            config_results.update(bench_dataset(config, repeat))
+
+            for key, value in config_results.items():
+                results[f'{name}/{key}'] = value
+
+    return results
+
+def is_higher_better(key):
+    return key.endswith('_per_sec')
+
+def compare(baseline, current, threshold):
+    """
+    returns keys of metrics worse than baseline by more than threshold
+    """
+    for key in ['torch', 'threads', 'configs', 'options']:
+        if baseline['meta'].get(key) != current['meta'].get(key):
+            print('{} differs from baseline: {} -> {}'.format(key, baseline['meta'].get(key), current['meta'].get(key)))
+
+    regressions = []
+    print('{:<55} {:>12} {:>12} {:>8}'.format('metric', 'baseline', 'current', 'change'))
+    for key, base_value in baseline['results'].items():
+        if key not in current['results']:
+            continue
+
+        value = current['results'][key]
+        change = value / base_value - 1 if base_value != 0 else 0.0
+        worse = -change if is_higher_better(key) else change
+
+        mark = ''
+        if threshold < worse:
+            regressions.append(key)
+            mark = ' REGRESSION'
+        print('{:<55} {:>12.3f} {:>12.3f} {:>+7.1f}%{}'.format(key, base_value, value, change * 100, mark))
+
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(add_help=True)
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    parser_run = subparsers.add_parser('run', help='run benchmarks with synthetic data on cpu')
+    parser_run.add_argument('--output', default='benchmark.json', help='json file results are written to')
+    parser_run.add_argument('--configs', default='tiny,small', help='comma separated names of model sizes in {}'.format(', '.join(CONFIGS)))
+    parser_run.add_argument('--repeat', type=int, default=10, help='number of measurements, the median is recorded')
+    parser_run.add_argument('--threads', type=int, default=None, help='number of threads torch uses')
+    parser_run.add_argument('options', nargs=argparse.REMAINDER, help='options of transformer.py given after --, e.g. -- --attention_impl fused')
+
+    parser_compare = subparsers.add_parser('compare', help='compare results with baseline and exit with 1 when regressed')
+    parser_compare.add_argument('baseline', help='json file of baseline results')
+    parser_compare.add_argument('current', help='json file of current results')
+    parser_compare.add_argument('--threshold', type=float, default=0.1, help='relative change regarded as regression')
+
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+
+        regressions = compare(baseline, current, args.threshold)
+        print('{} regressions'.format(len(regressions)))
+        sys.exit(1 if 0 < len(regressions) else 0)
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    options = [option for option in args.options if option != '--']
+    results = run_benchmarks(args.configs.split(','), args.repeat, options)
+
+    output = {
+        'meta': {
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'threads': torch.get_num_threads(),
+            'configs': {name: CONFIGS[name] for name in args.configs.split(',')},
+            'options': options,
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2)
+    print(f'save results to {args.output}')
@@ -1,7 +1,5 @@
 #!/bin/bash
 
-IS_CPU=$1
-
 git submodule update --init
 
 pushd sentencepiece
@@ -16,14 +14,4 @@ if [ ! -d venv-transformer ]; then
 fi
 source venv-transformer/bin/activate
 
-pip install torch==1.4.0 torchvision==0.5.0 tensorboard==2.2.0 nltk==3.4.5
-
-pushd apex
-git checkout 11faaca7c8ff7a7ba6d55854a9ee2689784f7ca5
-if $IS_CPU; then
-    pip install -v --no-cache-dir --global-option="--cpp_ext" ./
-else
-    pip install -v --no-cache-dir --global-option="--cpp_ext" --global-option="--cuda_ext" ./
-fi
-popd
-
+pip install torch==2.3.1 torchvision==0.18.1 tensorboard==2.2.0 sentencepiece==0.2.0
@@ -3,14 +3,30 @@ import sys
 import time
 import math
 import argparse
+import itertools
+import copy
+import shutil
+import sqlite3
+import hashlib
+import json
+import queue
+import threading
+import collections
+import contextlib
+import traceback
+import resource
+import datetime
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 import numpy as np
 import torch
 import torch.nn as nn
 from torch import optim
 import torch.nn.functional as F
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from torch.utils.tensorboard import SummaryWriter
-from nltk.translate.bleu_score import corpus_bleu
-import apex
+from torch.utils.checkpoint import checkpoint
 
 BOS_ID = 1
 EOS_ID = 2
@@ -40,19 +56,37 @@ class SimpleAttention(nn.Module):
         return self.out_lin(output)
 
 class MultiHeadAttention(nn.Module):
-    def __init__(self, n_heads, dim, dropout):
+    NEW_ID = itertools.count()
+    IMPLS = ['reference', 'fused', 'chunked']
+
+    def __init__(self, n_heads, dim, dropout, is_source=False, impl='reference', chunk_size=64):
         super(MultiHeadAttention, self).__init__()
 
+        assert impl in MultiHeadAttention.IMPLS, f'unknown attention impl: {impl}'
+
+        self.layer_id = next(MultiHeadAttention.NEW_ID)
+        self.is_source = is_source
         self.n_heads = n_heads
         self.dim = dim
         self.dropout = dropout
+        self.impl = impl
+        self.chunk_size = chunk_size
 
         self.q_lin = nn.Linear(dim, dim)
         self.k_lin = nn.Linear(dim, dim)
         self.v_lin = nn.Linear(dim, dim)
         self.out_lin = nn.Linear(dim, dim)
 
-    def forward(self, x, memory, mask):
+        # not buffers to keep state_dict compatible with saved models
+        self.kv_weight = None
+        self.kv_weight_key = None
+
+    def forward(self, x, memory, mask, cache=None):
+        """
+        cache is a dict shared by all layers of a model while decoding incrementally.
+        self attention appends key/value of new positions to its cached ones,
+        source attention computes key/value of encoder output only once.
+        """
         batch_size, _, dim = x.shape
         assert dim == self.dim, 'dimension mismatched'
 
@@ -67,23 +101,87 @@ class MultiHeadAttention(nn.Module):
             return x.contiguous().view(batch_size, -1, dim)
 
         q = split(self.q_lin(x))
-        k = split(self.k_lin(memory))
-        v = split(self.v_lin(memory))
+        if cache is not None and self.is_source and self.layer_id in cache:
+            k, v = cache[self.layer_id]
+        elif self.impl == 'fused' and isinstance(self.k_lin, nn.Linear):
+            # query is projected from normalized input but key and value from memory,
+            # so only key and value projections can be fused
+            weight, bias = self._get_kv_weight()
+            k, v = F.linear(memory, weight, bias).chunk(2, dim=-1)
+            k, v = split(k), split(v)
+        else:
+            k = split(self.k_lin(memory))
+            v = split(self.v_lin(memory))
 
-        q = q / math.sqrt(dim_per_head)
+        if cache is not None:
+            if not self.is_source and self.layer_id in cache:
+                k_, v_ = cache[self.layer_id]
+                k = torch.cat([k_, k], dim=2)
+                v = torch.cat([v_, v], dim=2)
+            cache[self.layer_id] = (k, v)
 
         shape = mask.shape
         mask_shape = (shape[0], 1, shape[1], shape[2]) if mask.dim() == 3 else (shape[0], 1, 1, shape[1])
+        mask = mask.view(mask_shape)
+
+        if self.impl == 'fused':
+            dropout = self.dropout if self.training else 0.0
+            output = F.scaled_dot_product_attention(q, k, v, attn_mask=~mask, dropout_p=dropout)
+        elif self.impl == 'chunked':
+            output = self._attend_chunked(q, k, v, mask)
+        else:
+            output = self._attend(q, k, v, mask)
+
+        output = combine(output)
+
+        return self.out_lin(output)
+
+    def _get_kv_weight(self):
+        """
+        concatenated weight and bias of key and value projections.
+        without autograd they are cached until the parameters are updated, moved or loaded,
+        so that decoding step by step does not copy them every step
+        """
+        params = [self.k_lin.weight, self.v_lin.weight, self.k_lin.bias, self.v_lin.bias]
+        if torch.is_grad_enabled() or torch.jit.is_tracing():
+            return torch.cat(params[:2]), torch.cat(params[2:])
+
+        key = tuple((p.data_ptr(), p._version) for p in params)
+        if self.kv_weight_key != key:
+            self.kv_weight = (torch.cat(params[:2]), torch.cat(params[2:]))
+            self.kv_weight_key = key
+
+        return self.kv_weight
+
+    def _attend(self, q, k, v, mask):
+        q = q / math.sqrt(q.size(-1))
+
         logit = torch.matmul(q, k.transpose(2, 3))
-        logit.masked_fill_(mask.view(mask_shape), -float('inf'))
+        logit.masked_fill_(mask, -float('inf'))
 
         weights = F.softmax(logit, dim=-1)
         weights = F.dropout(weights, p=self.dropout, training=self.training)
 
-        output = torch.matmul(weights, v)
-        output = combine(output)
+        return torch.matmul(weights, v)
 
-        return self.out_lin(output)
+    def _attend_chunked(self, q, k, v, mask):
+        """
+        attends chunk_size queries at a time so that whole score matrix is never held.
+        in training, scores of a chunk are recomputed in backward instead of being kept.
+        """
+        outputs = []
+        for start in range(0, q.size(2), self.chunk_size):
+            end = start + self.chunk_size
+            chunk_mask = mask if mask.size(2) == 1 else mask[:, :, start:end]
+
+            if torch.is_grad_enabled():
+                output = checkpoint(self._attend, q[:, :, start:end], k, v, chunk_mask, use_reentrant=False)
+            else:
+                output = self._attend(q[:, :, start:end], k, v, chunk_mask)
+
+            outputs.append(output)
+
+        return torch.cat(outputs, dim=2)
 
 class FeedForward(nn.Module):
     def __init__(self, dim_in, dim_hidden, dim_out, dropout):
@@ -107,9 +205,9 @@ class ResidualNormalizationWrapper(nn.Module):
         self.dropout = dropout
         self.normal = nn.LayerNorm(dim)
 
-    def forward(self, input, *args):
+    def forward(self, input, *args, **kwargs):
         x = self.normal(input)
-        x = self.layer(x, *args)
+        x = self.layer(x, *args, **kwargs)
         x = F.dropout(x, p=self.dropout, training=self.training)
         return input + x
 
@@ -124,6 +222,7 @@ class TransformerModel(nn.Module):
         self.dim = config.dim
         self.dim_hidden = config.dim * 4
         self.dropout = config.dropout
+        self.checkpoint_layers = config.checkpoint_layers
 
         self.token_embeddings = nn.Embedding(config.vocab_size, config.dim)
         self.position_embeddings = nn.Embedding(config.n_words, config.dim)
@@ -134,11 +233,11 @@ class TransformerModel(nn.Module):
         self.source_attentions = nn.ModuleList()
         self.ffns = nn.ModuleList()
         for _ in range(self.n_layers):
-            attention = MultiHeadAttention(self.n_heads, self.dim, self.dropout)
+            attention = MultiHeadAttention(self.n_heads, self.dim, self.dropout, impl=config.attention_impl, chunk_size=config.attention_chunk_size)
             self.attentions.append(ResidualNormalizationWrapper(self.dim, attention, self.dropout))
 
             if (is_decoder):
-                source_attention = MultiHeadAttention(self.n_heads, self.dim, self.dropout)
+                source_attention = MultiHeadAttention(self.n_heads, self.dim, self.dropout, is_source=True, impl=config.attention_impl, chunk_size=config.attention_chunk_size)
                 self.source_attentions.append(ResidualNormalizationWrapper(self.dim, source_attention, self.dropout))
 
             ffn = FeedForward(self.dim, self.dim_hidden, self.dim, self.dropout)
@@ -151,48 +250,203 @@ class TransformerModel(nn.Module):
             if p.dim() > 1:
                 nn.init.xavier_uniform_(p)
 
-    def _get_mask(self, input, causal):
-        device = self.config.device
-        pad_tensor = torch.empty(1).fill_(PAD_ID).expand_as(input).cpu()
-        mask = input.to(dtype=torch.int).cpu() == pad_tensor.cpu()
+        # not persistent to keep state_dict compatible with saved models, but moved with the module
+        self.register_buffer('positions', torch.arange(config.n_words, device=config.device), persistent=False)
+        self.register_buffer('causal_mask', torch.triu(torch.ones(config.n_words, config.n_words, dtype=torch.bool, device=config.device), diagonal=1), persistent=False)
+
+    def _get_mask(self, input, causal, start=0):
+        """
+        returns padding mask of positions from start and attention mask of them.
+        both are built on device from causal mask cached for the longest sentence.
+        """
+        mask = input == PAD_ID
+        n_words = input.size(1)
 
         if not causal:
-            return mask.to(device), mask.to(device)
+            return mask[:, start:], mask
 
-        batch_size, n_words = input.size()
-        shape = (batch_size, n_words, n_words)
-        source_mask_np = np.triu(np.ones(shape), k=1).astype('uint8')
-        source_mask = torch.from_numpy(source_mask_np) == 1
-        pad_mask = mask.unsqueeze(-2)
-        source_mask = pad_mask | source_mask
+        att_mask = mask.unsqueeze(1) | self.causal_mask[start:n_words, :n_words]
 
-        return mask.to(device), source_mask.to(device)
+        return mask[:, start:], att_mask
 
-    def forward(self, input, src_enc=None, src_mask=None, causal=False):
-        batch_size, n_sentences = input.size()
-        (mask, att_mask) = self._get_mask(input, causal)
+    def forward(self, input, src_enc=None, src_mask=None, causal=False, cache=None):
+        """
+        when cache is given, input is the whole prefix generated so far
+        but only the positions that are not in cache yet are computed.
+        """
+        start = 0 if cache is None else cache['slen']
+        (mask, att_mask) = self._get_mask(input, causal, start)
+
+        positions = self.positions[start:input.size(1)]
+        input = input[:, start:]
 
-        positions = torch.arange(n_sentences).to(dtype=torch.long, device=self.config.device).unsqueeze(0)
         x = self.token_embeddings(input.to(dtype=int))
-        x = x + self.position_embeddings(positions).expand_as(x)
+        x = x + self.position_embeddings(positions)
 
         x = self.layer_norm_emb(x)
         x = F.dropout(x, p=self.dropout, training=self.training)
-        x[mask] = 0
+        x = x.masked_fill(mask.unsqueeze(-1), 0)
+
+        if 0 < self.checkpoint_layers and self.training and torch.is_grad_enabled():
+            # activations in every checkpoint_layers layers are recomputed in backward instead of being kept,
+            # rng state is restored in recomputation so that dropout masks are same
+            for first in range(0, self.n_layers, self.checkpoint_layers):
+                last = min(first + self.checkpoint_layers, self.n_layers)
+                x = checkpoint(self._layers, first, last, x, mask, att_mask, src_enc, src_mask, use_reentrant=False)
+        else:
+            x = self._layers(0, self.n_layers, x, mask, att_mask, src_enc, src_mask, cache)
 
-        for i in range(self.n_layers):
-            x = self.attentions[i](x, x, att_mask)
+        if cache is not None:
+            cache['slen'] += x.size(1)
 
-            if self.is_decoder:
-                x = self.source_attentions[i](x, src_enc, src_mask)
+        return x
 
-            x = self.ffns[i](x)
-            x[mask] = 0
+    def _layers(self, first, last, x, mask, att_mask, src_enc, src_mask, cache=None):
+        """
+        layers from first to last, last is not included
+        """
+        for i in range(first, last):
+            x = self._layer(i, x, mask, att_mask, src_enc, src_mask, cache)
 
         return x
 
-    def predict(self, x):
-        return F.log_softmax(self.pred_layer(x), dim=-1)
+    def _layer(self, i, x, mask, att_mask, src_enc, src_mask, cache=None):
+        x = self.attentions[i](x, x, att_mask, cache=cache)
+
+        if self.is_decoder:
+            x = self.source_attentions[i](x, src_enc, src_mask, cache=cache)
+
+        x = self.ffns[i](x)
+        return x.masked_fill(mask.unsqueeze(-1), 0)
+
+    def predict(self, x, output_weights=None):
+        """
+        output_weights are rows of pred_layer for restricted vocabulary returned by get_output_weights,
+        log probabilities are computed over them
+        """
+        if output_weights is None:
+            return F.log_softmax(self.pred_layer(x), dim=-1)
+
+        return F.log_softmax(F.linear(x, *output_weights), dim=-1)
+
+    def get_output_weights(self, vocab):
+        if isinstance(self.pred_layer, nn.Linear):
+            weight, bias = self.pred_layer.weight, self.pred_layer.bias
+        else:
+            # dynamically quantized linear
+            weight, bias = self.pred_layer.weight().dequantize(), self.pred_layer.bias()
+
+        return weight[vocab], bias[vocab]
+
+class EncoderGraph(nn.Module):
+    """
+    encodes source sentences and projects them to key/value of source attentions of all decoder layers
+    so that the decoder step graph does not recompute them.
+    returns src_mask (batch, slen) and src_k, src_v (n_layers, batch, n_heads, slen, dim_per_head).
+    """
+    def __init__(self, encoder, decoder):
+        super(EncoderGraph, self).__init__()
+
+        self.encoder = encoder
+        self.decoder = decoder
+
+    def forward(self, x):
+        enc_output = self.encoder(x)
+        batch_size, _, dim = enc_output.shape
+        n_heads = self.decoder.n_heads
+
+        def split(x):
+            return x.view(batch_size, -1, n_heads, dim // n_heads).transpose(1, 2)
+
+        keys, values = [], []
+        for wrapper in self.decoder.source_attentions:
+            keys.append(split(wrapper.layer.k_lin(enc_output)))
+            values.append(split(wrapper.layer.v_lin(enc_output)))
+
+        return x == PAD_ID, torch.stack(keys), torch.stack(values)
+
+class DecoderStepGraph(nn.Module):
+    """
+    computes log probabilities of next words from the last generated words,
+    cache of self attentions is given and returned explicitly as k, v (n_layers, batch, n_heads, length, dim_per_head)
+    and pad_mask (batch, length), padding mask of the words generated before.
+    """
+    def __init__(self, decoder):
+        super(DecoderStepGraph, self).__init__()
+
+        self.decoder = decoder
+
+    def forward(self, words, position, src_mask, src_k, src_v, k, v, pad_mask):
+        decoder = self.decoder
+
+        # same cache as TransformerModel.forward takes
+        cache = {}
+        for i in range(decoder.n_layers):
+            cache[decoder.attentions[i].layer.layer_id] = (k[i], v[i])
+            cache[decoder.source_attentions[i].layer.layer_id] = (src_k[i], src_v[i])
+
+        # same masks as TransformerModel._get_mask builds from the whole prefix,
+        # the last word is not masked by causal mask
+        mask = words == PAD_ID
+        pad_mask = torch.cat([pad_mask, mask], dim=1)
+        att_mask = pad_mask.unsqueeze(1)
+
+        x = decoder.token_embeddings(words)
+        x = x + decoder.position_embeddings(position)
+        x = decoder.layer_norm_emb(x)
+        x = x.masked_fill(mask.unsqueeze(-1), 0)
+
+        for i in range(decoder.n_layers):
+            x = decoder._layer(i, x, mask, att_mask, None, src_mask, cache)
+
+        keys = [cache[decoder.attentions[i].layer.layer_id][0] for i in range(decoder.n_layers)]
+        values = [cache[decoder.attentions[i].layer.layer_id][1] for i in range(decoder.n_layers)]
+
+        return decoder.predict(x[:, -1]), torch.stack(keys), torch.stack(values), pad_mask
+
+class PhaseTimer(object):
+    """
+    accumulates wall-clock time of named phases. cuda is synchronized at both ends of a phase
+    so that asynchronous kernels are counted in the phase launching them.
+    phases are also labeled in traces of torch profiler.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.times = collections.defaultdict(float)
+        self.counts = collections.defaultdict(int)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        self.__synchronize()
+        start_time = time.time()
+        with torch.profiler.record_function(name):
+            yield
+        self.__synchronize()
+
+        self.times[name] += time.time() - start_time
+        self.counts[name] += 1
+
+    def iterate(self, iterable, name):
+        """
+        yields items of iterable timing each fetch as the phase
+        """
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, None)
+            if item is None:
+                return
+            yield item
+
+    def pop(self, names):
+        """
+        returns total seconds and counts of the phases, and resets them
+        """
+        return {name: (self.times.pop(name, 0.0), self.counts.pop(name, 0)) for name in names}
+
+    def __synchronize(self):
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
 
 class Trainer(object):
     def __init__(self, config):
@@ -207,47 +461,127 @@ class Trainer(object):
         self.optimizer_dec = self._get_optimizer(self.decoder)
         self.scheduler_dec = self._get_scheduler(self.optimizer_dec)
 
-        if self.config.fp16:
-            self.encoder, self.optimizer_enc = apex.amp.initialize(
-                self.encoder,
-                self.optimizer_enc,
-                opt_level='O1' if args.fp16 else 'O0'
-            )
-            self.decoder, self.optimizer_dec = apex.amp.initialize(
-                self.decoder,
-                self.optimizer_dec,
-                opt_level='O1' if args.fp16 else 'O0'
-            )
+        # GradScaler is needed only for float16, bfloat16 has the same exponent range as float32
+        self.scaler = torch.amp.GradScaler('cuda', enabled=config.precision == 'fp16')
 
         self.criterion = LabelSmoothing(config.vocab_size, 0.1).to(config.device)
+        self.shortlist = Shortlist.load(config) if 0 < config.shortlist else None
 
-        model_path = config.best_model_path if config.eval_only else config.model_path
-        self.__load_from_model_path(model_path)
+        # quantized weights can be loaded only to quantized modules
+        if config.quantized:
+            self.encoder, self.decoder = Trainer.quantize(self.encoder), Trainer.quantize(self.decoder)
 
         self.start_time = time.time()
+        self.timer = PhaseTimer(config.device)
+        self.profiler = None
+        self.profile_end_steps = None
         self.bleu_history = []
-        self.steps = 0
+        self.evaluator = None
+        # checkpoints of epochs evaluated in background, kept until their results arrive
+        self.pending_evaluations = {}
+        self.steps = config.last_steps
         self.stats = {
             'sentences': 0,
             'words': 0,
             'loss': 0.0,
         }
+        self.accumulated = {
+            'batches': 0,
+            'words': 0,
+            'loss': 0.0,
+        }
 
-        self.writer = SummaryWriter(log_dir=config.tensorboard_log_dir)
+        self.loaded_model_path = None
+        model_path = config.best_model_path if config.eval_only else config.model_path
+        self.__load_from_model_path(model_path)
 
-        # dummy call to take over learning rate
-        # https://discuss.pytorch.org/t/a-problem-occured-when-resuming-an-optimizer/28822
-        if 0 < config.last_steps:
-            for _ in range(config.last_steps):
-                self.step_end(False)
+        self.translation_cache = None
+        if 0 < config.translation_cache_size or config.translation_cache_db is not None:
+            self.translation_cache = TranslationCache(self.__get_translation_namespace(), config.translation_cache_size, config.translation_cache_db)
+
+        # only master process writes logs and models in distributed training
+        self.is_master = config.rank == 0
+        self.writer = SummaryWriter(log_dir=config.tensorboard_log_dir) if self.is_master else None
+        self.checkpoint = Checkpoint()
+
+        if 1 < config.world_size:
+            self.__broadcast_parameters()
+
+    def __broadcast_parameters(self):
+        for model in [self.encoder, self.decoder]:
+            for p in model.parameters():
+                dist.broadcast(p.data, 0)
+
+    def __all_reduce_grads(self):
+        grads = [p.grad for model in [self.encoder, self.decoder] for p in model.parameters() if p.grad is not None]
+        flat = torch.cat([grad.flatten() for grad in grads])
+        dist.all_reduce(flat)
+
+        offset = 0
+        for grad in grads:
+            grad.copy_(flat[offset:offset + grad.numel()].view_as(grad))
+            offset += grad.numel()
+
+    def __all_reduce_sum(self, *values):
+        values = torch.tensor(values, dtype=torch.float64, device=self.config.device)
+        dist.all_reduce(values)
+        return values.tolist()
+
+    def __add_scalar(self, tag, value, step):
+        if self.writer is not None:
+            self.writer.add_scalar(tag, value, step, time.time())
+
+    def save(self, epoch, paths, epoch_batches=0, checkpoint=None):
+        """
+        epoch is the last finished one, epoch_batches is the number of batches trained in the next epoch.
+        the same model is saved to all paths. checkpoint taken by get_checkpoint before is saved if given.
+        """
+        if not self.is_master:
+            return
 
-    def save(self, epoch, model_path):
+        data, header = checkpoint if checkpoint is not None else self.get_checkpoint(epoch, epoch_batches)
+        bleu_history = list(self.bleu_history)
+        data = {**data, 'bleu_history': bleu_history}
+        header = {**header, 'bleu_history': bleu_history}
+        self.checkpoint.save(data, header, paths)
+        print('save model to {}'.format(', '.join(paths)))
+
+    def get_checkpoint(self, epoch, epoch_batches=0):
+        """
+        returns copies of current states on cpu and header
+        """
+        header = {
+            **self.__get_hyperparameters(epoch),
+            'epoch_batches': epoch_batches,
+        }
         data = {
             'encoder': self.encoder.state_dict(),
             'decoder': self.decoder.state_dict(),
             'optimizer_enc': self.optimizer_enc.state_dict(),
             'optimizer_dec': self.optimizer_dec.state_dict(),
-            'amp': apex.amp.state_dict() if self.config.fp16 else None,
+            'scheduler_enc': self.scheduler_enc.state_dict(),
+            'scheduler_dec': self.scheduler_dec.state_dict(),
+            'amp': self.scaler.state_dict() if self.config.fp16 else None,
+            'rng': self.__get_rng_state(),
+            **header,
+        }
+        return Checkpoint.snapshot(data), header
+
+    def __get_rng_state(self):
+        return {
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state() if self.config.device.type == 'cuda' else None,
+            'numpy': np.random.get_state(),
+        }
+
+    def __set_rng_state(self, state):
+        torch.set_rng_state(state['torch'].cpu())
+        if self.config.device.type == 'cuda' and state['cuda'] is not None:
+            torch.cuda.set_rng_state(state['cuda'].cpu())
+        np.random.set_state(state['numpy'])
+
+    def __get_hyperparameters(self, epoch):
+        return {
             'batch_size': self.config.batch_size,
             'vocab_size': self.config.vocab_size,
             'n_layers': self.config.n_layers,
@@ -255,24 +589,164 @@ class Trainer(object):
             'n_words': self.config.n_words,
             'dim': self.config.dim,
             'fp16': self.config.fp16,
+            'precision': self.config.precision,
             'name': self.config.name,
             'last_epoch': epoch,
             'last_steps': self.steps,
         }
-        torch.save(data, model_path)
-        print(f'save model to {self.config.model_path}')
+
+    def export_inference(self, path):
+        """
+        saves weights and hyperparameters only, linear layers are quantized to int8 with --quantize.
+        BLEU of the quantized model is compared with the float one.
+        """
+        if self.config.quantize and not self.config.quantized:
+            bleu = self.evaluate()
+            self.encoder, self.decoder = Trainer.quantize(self.encoder), Trainer.quantize(self.decoder)
+            quantized_bleu = self.evaluate()
+            if bleu is not None:
+                print('bleu: {:.2f} -> {:.2f} ({:+.2f}) by quantization'.format(bleu, quantized_bleu, quantized_bleu - bleu))
+
+        header = {
+            **self.__get_hyperparameters(self.config.start_epoch - 1),
+            'inference_only': True,
+            'quantized': self.config.quantize or self.config.quantized,
+        }
+        data = {
+            'encoder': self.encoder.state_dict(),
+            'decoder': self.decoder.state_dict(),
+            **header,
+        }
+        self.checkpoint.save(data, header, [path])
+        self.checkpoint.wait()
+        print(f'save model for inference to {path}')
+
+    def export_graph(self, graph_dir):
+        """
+        exports encoder and one step of decoder as TorchScript graphs that translate_exported.py runs,
+        then checks that it generates the same sentences as this trainer on evaluation data.
+        """
+        self.encoder.eval()
+        self.decoder.eval()
+
+        os.makedirs(graph_dir, exist_ok=True)
+        device = self.config.device
+
+        # traced by the longest sentences so that loops by length in attention cover any sentence
+        x = torch.full((2, self.config.n_words), 4, dtype=torch.long, device=device)
+        x[1, self.config.n_words // 2:] = PAD_ID
+
+        encoder = EncoderGraph(self.encoder, self.decoder)
+        decoder_step = DecoderStepGraph(self.decoder)
+        with torch.no_grad():
+            encoder = torch.jit.trace(encoder, (x,))
+            src_mask, src_k, src_v = encoder(x)
+
+            shape = list(src_k.shape)
+            shape[3] = 1
+            words = torch.full((2, 1), BOS_ID, dtype=torch.long, device=device)
+            position = torch.tensor([1], device=device)
+            k, v = torch.zeros(shape, device=device), torch.zeros(shape, device=device)
+            pad_mask = torch.tensor([[False], [True]], device=device)
+            decoder_step = torch.jit.trace(decoder_step, (words, position, src_mask, src_k, src_v, k, v, pad_mask))
+
+        encoder.save(f'{graph_dir}/encoder.pt')
+        decoder_step.save(f'{graph_dir}/decoder_step.pt')
+
+        meta = {
+            'vocab_size': self.config.vocab_size,
+            'n_layers': self.config.n_layers,
+            'n_heads': self.config.n_heads,
+            'n_words': self.config.n_words,
+            'dim': self.config.dim,
+            'max_len_a': self.config.max_len_a,
+            'max_len_b': self.config.max_len_b,
+            'bos_id': BOS_ID,
+            'eos_id': EOS_ID,
+            'pad_id': PAD_ID,
+        }
+        with open(f'{graph_dir}/graph.json', 'w') as f:
+            json.dump(meta, f, indent=2)
+        print(f'export graphs to {graph_dir}')
+
+        self.__check_exported_graph(graph_dir)
+
+    def __check_exported_graph(self, graph_dir):
+        from translate_exported import ExportedTranslator
+
+        data_type = 'dummy' if self.config.train_test else 'valid'
+        data = MTDataset(self.config, data_type)
+        if len(data) == 0:
+            print('no data to check exported graphs for data_type: {}'.format(data_type))
+            return
+
+        is_comparable = self.config.beam_size == 1 and self.config.precision == 'fp32'
+        if not is_comparable:
+            print('exported graphs decode greedily with fp32, sentences can differ from beam_size: {}, precision: {}'.format(self.config.beam_size, self.config.precision))
+
+        translator = ExportedTranslator(graph_dir, self.config.device_name)
+        dataloader = torch.utils.data.DataLoader(data, batch_size=self.config.batch_size, collate_fn=MTDataset.collate)
+
+        n_same = 0
+        times = collections.defaultdict(float)
+        for x, _ in dataloader:
+            start_time = time.time()
+            expected = self.translate(x)
+            times['model'] += time.time() - start_time
+
+            start_time = time.time()
+            generated = translator.translate(x)
+            times['graph'] += time.time() - start_time
+
+            n_same += (expected.cpu() == generated.cpu()).all(dim=1).sum().item()
+
+        print('same sentences: {}/{}'.format(n_same, len(data)))
+        print('time: ' + ', '.join(['{}: {:.2f}s'.format(key, value) for key, value in times.items()]))
+
+        if is_comparable and n_same < len(data):
+            raise RuntimeError('exported graphs in {} generate {} sentences different from the model'.format(graph_dir, len(data) - n_same))
+
+    @staticmethod
+    def quantize(model):
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
 
     def __load_from_model_path(self, path):
         if not os.path.isfile(path):
             return
-        data = torch.load(path, map_location=self.config.device_name)
+        data = torch.load(path, map_location=self.config.device_name, weights_only=False)
         self.encoder.load_state_dict(data['encoder'])
         self.decoder.load_state_dict(data['decoder'])
+        self.loaded_model_path = path
+        print(f'load model from {path}')
+
+        if data.get('inference_only', False):
+            return
+
         self.optimizer_enc.load_state_dict(data['optimizer_enc'])
         self.optimizer_dec.load_state_dict(data['optimizer_dec'])
-        if self.config.fp16:
-            apex.amp.load_state_dict(data['amp'])
-        print(f'load model from {path}')
+        # amp of models saved with apex has no state GradScaler can take over
+        if self.config.fp16 and data.get('amp') is not None and 'scale' in data['amp']:
+            self.scaler.load_state_dict(data['amp'])
+
+        if 'scheduler_enc' in data:
+            self.scheduler_enc.load_state_dict(data['scheduler_enc'])
+            self.scheduler_dec.load_state_dict(data['scheduler_dec'])
+        elif 0 < self.config.last_steps:
+            # models saved without schedulers, learning rate is computed directly from steps
+            for scheduler in [self.scheduler_enc, self.scheduler_dec]:
+                scheduler.last_epoch = self.config.last_steps - 1
+                scheduler.step()
+
+        if 'rng' in data:
+            self.__set_rng_state(data['rng'])
+
+        # history reported by background evaluation after the model was saved is written only to its header
+        header = Checkpoint.read_header(path) if os.path.isfile(Checkpoint.header_path(path)) else data
+        self.bleu_history = header.get('bleu_history', [])
+
+    def autocast(self):
+        dtype = torch.bfloat16 if self.config.precision == 'bf16' else torch.float16
+        return torch.autocast(self.config.device.type, dtype=dtype, enabled=self.config.precision != 'fp32')
 
     def _get_optimizer(self, model):
         return optim.Adam(model.parameters(), lr=1.0, betas=(0.9, 0.98), eps=1e-9)
@@ -287,65 +761,270 @@ class Trainer(object):
 
         return optim.lr_scheduler.LambdaLR(optimizer, lr_lambda=update)
 
-    def __generate(self, x):
+    @torch.no_grad()
+    def __generate(self, x, enc_output=None):
+        """
+        enc_output is computed from x if not given
+        """
         self.encoder.eval()
         self.decoder.eval()
 
-        max_len = self.config.n_words
+        # words are predicted only from vocabulary of shortlist of the batch
+        vocab = None if self.shortlist is None else self.shortlist.get_vocab(x)
+
+        with self.autocast():
+            if enc_output is None:
+                enc_output = self.encoder(x)
+
+            if 1 < self.config.beam_size:
+                return self.__generate_beam(x, enc_output, vocab)
+
+            return self.__generate_greedy(x, enc_output, vocab)
+
+    def __generate_greedy(self, x, enc_output, vocab=None):
+        """
+        sentences that have generated EOS are removed from the batch with their cache
+        not to consume compute, they are written to their rows of the output.
+        """
+        device = self.config.device
+        max_len = self.__get_max_len(x)
         src_mask = x == PAD_ID
-        enc_output = self.encoder(x)
 
         batch_size, _ = x.shape
-        generated = torch.empty(batch_size, max_len).fill_(PAD_ID)
-        generated[:,0] = BOS_ID
-        generated = generated.to(self.config.device)
+        output = torch.full((batch_size, max_len), PAD_ID, dtype=torch.long, device=device)
+        output[:, 0] = BOS_ID
 
-        unfinished_sents = torch.ones(batch_size, device=self.config.device)
+        generated = output.clone()
+        sent_ids = torch.arange(batch_size, device=device)
+        cache = {'slen': 0}
+        output_weights = None if vocab is None else self.decoder.get_output_weights(vocab)
 
         for i in range(1, max_len):
-            dec_output = self.decoder(generated[:, :i], enc_output, src_mask, True)
-            gen_output = self.decoder.predict(dec_output[:, -1])
-            _, next_words = torch.max(gen_output, dim=1)
+            with self.timer.phase('generate_step'):
+                dec_output = self.decoder(generated[:, :i], enc_output, src_mask, True, cache=cache)
+                gen_output = self.decoder.predict(dec_output[:, -1], output_weights)
+                _, next_words = torch.max(gen_output, dim=1)
+            if vocab is not None:
+                next_words = vocab[next_words]
+
+            generated[:, i] = next_words
 
-            generated[:, i] = next_words * unfinished_sents + PAD_ID * (1 - unfinished_sents)
+            is_finished = next_words == EOS_ID
+            if i == max_len - 1 or not is_finished.any():
+                continue
+
+            output[sent_ids[is_finished], :i+1] = generated[is_finished, :i+1]
 
-            unfinished_sents.mul_(next_words.ne(EOS_ID).long())
-            if unfinished_sents.max() == 0:
+            alive = ~is_finished
+            if not alive.any():
                 break
 
-        return generated.to(dtype=torch.int)
+            sent_ids = sent_ids[alive]
+            generated = generated[alive]
+            enc_output = enc_output[alive]
+            src_mask = src_mask[alive]
+            self.__select_cache(cache, alive)
 
-    def __predict(self, x, y, causal):
-        enc_output = self.encoder(x)
+        # sentences that reached max_len without EOS
+        output[sent_ids] = generated
+
+        return output.to(dtype=torch.int)
+
+    def __generate_beam(self, x, enc_output, vocab=None):
+        """
+        beams are flattened into batch dimension, row of sentence s and beam b is s * beam_size + b.
+        sentences whose search is done are removed from the batch not to consume compute.
+        """
+        device = self.config.device
+        beam_size = self.config.beam_size
+        vocab_size = self.config.vocab_size if vocab is None else vocab.size(0)
+        output_weights = None if vocab is None else self.decoder.get_output_weights(vocab)
+        max_len = self.__get_max_len(x)
+
+        src_mask = (x == PAD_ID).repeat_interleave(beam_size, dim=0)
+        enc_output = enc_output.repeat_interleave(beam_size, dim=0)
+
+        batch_size, _ = x.shape
+        generated = torch.full((batch_size * beam_size, max_len), PAD_ID, dtype=torch.long, device=device)
+        generated[:, 0] = BOS_ID
+
+        # only first beam is alive at first step not to get same hypotheses
+        beam_scores = torch.zeros(batch_size, beam_size, device=device)
+        beam_scores[:, 1:] = -float('inf')
+        beam_scores = beam_scores.view(-1)
+
+        # best finished hypothesis and length normalized scores of top beam_size finished ones
+        best = torch.full((batch_size, max_len), PAD_ID, dtype=torch.long, device=device)
+        best[:, 0] = BOS_ID
+        finished_scores = torch.full((batch_size, beam_size), -float('inf'), device=device)
+
+        sent_ids = torch.arange(batch_size, device=device)
+        cache = {'slen': 0}
+
+        for i in range(1, max_len):
+            n_sents = sent_ids.size(0)
+            is_last = i == max_len - 1
+
+            with self.timer.phase('generate_step'):
+                dec_output = self.decoder(generated[:, :i], enc_output, src_mask, True, cache=cache)
+                scores = self.decoder.predict(dec_output[:, -1], output_weights) + beam_scores.unsqueeze(1)
+                scores = scores.view(n_sents, beam_size * vocab_size)
+
+                cand_scores, cand_ids = scores.topk(2 * beam_size, dim=1)
+            cand_beams = cand_ids // vocab_size
+            cand_words = cand_ids % vocab_size
+            if vocab is not None:
+                cand_words = vocab[cand_words]
+            cand_rows = torch.arange(n_sents, device=device).unsqueeze(1) * beam_size + cand_beams
+
+            # hypotheses ending with EOS in top beam_size candidates are finished,
+            # all of them are finished at the last step because no position is left
+            is_eos = cand_words == EOS_ID
+            is_finished = (is_eos | is_last)[:, :beam_size] & (cand_scores[:, :beam_size] > -float('inf'))
+            normalized = cand_scores[:, :beam_size] / (i ** self.config.length_penalty)
+            normalized = normalized.masked_fill(~is_finished, -float('inf'))
+
+            prev_best = finished_scores[sent_ids, 0]
+            new_best, new_best_idx = normalized.max(dim=1)
+            improved = new_best > prev_best
+            if improved.any():
+                rows = cand_rows[improved, new_best_idx[improved]]
+                targets = sent_ids[improved]
+                best[targets, :i] = generated[rows, :i]
+                best[targets, i] = cand_words[improved, new_best_idx[improved]]
+
+            merged = torch.cat([finished_scores[sent_ids], normalized], dim=1)
+            finished_scores[sent_ids] = merged.topk(beam_size, dim=1)[0]
+
+            if is_last:
+                break
+
+            # first beam_size candidates that do not end with EOS continue
+            _, order = is_eos.to(dtype=torch.int).sort(dim=1, stable=True)
+            order = order[:, :beam_size]
+            next_scores = cand_scores.gather(1, order)
+            next_words = cand_words.gather(1, order)
+            next_rows = cand_rows.gather(1, order)
+
+            # done when beam_size hypotheses are finished and no alive one can be better
+            worst_finished = finished_scores[sent_ids, -1]
+            best_alive = next_scores[:, 0] / (i ** self.config.length_penalty)
+            is_done = (-float('inf') < worst_finished) & (best_alive <= worst_finished)
+
+            if is_done.all():
+                break
+
+            if is_done.any():
+                alive = ~is_done
+                sent_ids = sent_ids[alive]
+                next_scores = next_scores[alive]
+                next_words = next_words[alive]
+                next_rows = next_rows[alive]
+
+            next_rows = next_rows.view(-1)
+            generated = generated[next_rows]
+            generated[:, i] = next_words.view(-1)
+            beam_scores = next_scores.view(-1)
+            enc_output = enc_output[next_rows]
+            src_mask = src_mask[next_rows]
+            self.__select_cache(cache, next_rows)
+
+        return best.to(dtype=torch.int)
+
+    def __get_max_len(self, x):
+        """
+        generated length including BOS is bounded by max_len_a * (longest source length) + max_len_b
+        """
+        src_len = (x != PAD_ID).sum(dim=1).max().item()
+        max_len = int(self.config.max_len_a * src_len + self.config.max_len_b)
+        return max(2, min(self.config.n_words, max_len))
+
+    def __select_cache(self, cache, index):
+        for key in cache:
+            if key == 'slen':
+                continue
+            k, v = cache[key]
+            cache[key] = (k[index], v[index])
+
+    def __predict(self, x, y, causal, enc_output=None):
+        if enc_output is None:
+            enc_output = self.encoder(x)
         dec_output = self.decoder(y[:, :-1], enc_output, x == PAD_ID, causal)
 
         return self.decoder.predict(dec_output)
 
     def step(self, x, y):
+        """
+        accumulates gradients of a batch, parameters are updated every update_freq batches
+        or when tokens_per_update target tokens are accumulated. returns True when updated.
+        """
         self.encoder.train()
         self.decoder.train()
 
-        scores = self.__predict(x, y, True)
-        nwords = (y[:, 1:] != PAD_ID).sum().item()
-        loss = self.criterion(scores, y[:, 1:], nwords)
+        with self.timer.phase('forward'):
+            with self.autocast():
+                scores = self.__predict(x, y, True)
+            nwords = (y[:, 1:] != PAD_ID).sum().item()
 
-        optimizers = [self.optimizer_enc, self.optimizer_dec]
+            # sum of loss, gradients are normalized by number of accumulated tokens in update
+            loss = self.criterion(scores, y[:, 1:], 1)
 
-        if self.config.fp16:
-            with apex.amp.scale_loss(loss, optimizers) as scaled_loss:
-                scaled_loss.backward()
-        else:
-            loss.backward()
+        with self.timer.phase('backward'):
+            self.scaler.scale(loss).backward()
 
-        for optimizer in optimizers:
-            optimizer.step()
-            optimizer.zero_grad()
+        self.accumulated['batches'] += 1
+        self.accumulated['words'] += nwords
+        self.accumulated['loss'] += loss.item()
 
-        self.stats['loss'] = loss.item()
         self.stats['sentences'] += x.size(0)
         self.stats['words'] += nwords
 
-        self.writer.add_scalar('loss/train', loss, self.steps, time.time())
+        if 0 < self.config.tokens_per_update:
+            # all processes have to update at the same time, so tokens of all of them are counted
+            words = self.accumulated['words']
+            if 1 < self.config.world_size:
+                words = self.__all_reduce_sum(words)[0]
+            if words < self.config.tokens_per_update:
+                return False
+        elif self.accumulated['batches'] < self.config.update_freq:
+            return False
+
+        self.__update()
+        return True
+
+    def __update(self):
+        if 1 < self.config.world_size:
+            with self.timer.phase('all_reduce'):
+                self.__all_reduce_grads()
+                words, loss = self.__all_reduce_sum(self.accumulated['words'], self.accumulated['loss'])
+            self.stats['words'] += int(words) - self.accumulated['words']
+            self.accumulated['words'] = int(words)
+            self.accumulated['loss'] = loss
+
+        with self.timer.phase('optimizer'):
+            nwords = max(self.accumulated['words'], 1)
+            for model in [self.encoder, self.decoder]:
+                for p in model.parameters():
+                    if p.grad is not None:
+                        p.grad.div_(nwords)
+
+            optimizers = [self.optimizer_enc, self.optimizer_dec]
+
+            for optimizer in optimizers:
+                self.scaler.step(optimizer)
+            self.scaler.update()
+
+            for optimizer in optimizers:
+                optimizer.zero_grad()
+
+        self.stats['loss'] = self.accumulated['loss'] / nwords
+        self.__add_scalar('loss/train', self.stats['loss'], self.steps)
+
+        self.accumulated = {
+            'batches': 0,
+            'words': 0,
+            'loss': 0.0,
+        }
 
     def step_end(self, print_log=True):
         self.steps += 1
@@ -356,8 +1035,36 @@ class Trainer(object):
         self.scheduler_enc.step()
         self.scheduler_dec.step()
 
+        if self.evaluator is not None:
+            self.collect_evaluations()
+
+        if self.profiler is not None:
+            self.profiler.step()
+            if self.profile_end_steps <= self.steps:
+                self.profiler.stop()
+                self.profiler = None
+                print(f'save profile to {self.config.tensorboard_log_dir}')
+
+    def __start_profiler(self):
+        """
+        records profile of updates after a few ones of warmup, the trace is shown in tensorboard
+        """
+        wait, warmup = 1, 2
+        activities = [torch.profiler.ProfilerActivity.CPU]
+        if self.config.device.type == 'cuda':
+            activities.append(torch.profiler.ProfilerActivity.CUDA)
+
+        self.profiler = torch.profiler.profile(
+            activities=activities,
+            schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=self.config.profile_steps, repeat=1),
+            on_trace_ready=torch.profiler.tensorboard_trace_handler(self.config.tensorboard_log_dir),
+            record_shapes=True,
+            profile_memory=True)
+        self.profiler.start()
+        self.profile_end_steps = self.steps + wait + warmup + self.config.profile_steps
+
     def _print_log(self):
-        if self.steps % args.log_interval != 0:
+        if not self.is_master or self.steps % self.config.log_interval != 0:
             return
 
         current_time = time.time()
@@ -365,21 +1072,102 @@ class Trainer(object):
         lr = self.optimizer_enc.param_groups[0]['lr']
         print('step: {}, loss: {:.2f}, tokens/sec: {:.1f}, lr: {:.6f}'.format(self.steps, self.stats['loss'], self.stats['words'] / elapsed_time, lr))
 
+        # milliseconds per update of each phase
+        phases = self.timer.pop(['data', 'forward', 'backward', 'all_reduce', 'optimizer'])
+        n_updates = max(phases['optimizer'][1], 1)
+        times = {name: total * 1000 / n_updates for name, (total, count) in phases.items() if 0 < count}
+        for name, value in times.items():
+            self.__add_scalar(f'time/{name}', value, self.steps)
+
+        peak_memory = self.__get_peak_memory()
+        self.__add_scalar('memory/peak', peak_memory, self.steps)
+        print('time per update: ' + ', '.join(['{}: {:.1f}ms'.format(key, value) for key, value in times.items()]) + ', peak memory: {:.1f}MB'.format(peak_memory))
+
         self.start_time = current_time
         self.stats['sentences'] = 0
         self.stats['words'] = 0
 
+    def __get_peak_memory(self):
+        """
+        peak memory in MB allocated by tensors since the last call on cuda, or resident memory of the process on cpu
+        """
+        if self.config.device.type == 'cuda':
+            peak = torch.cuda.max_memory_allocated(self.config.device)
+            torch.cuda.reset_peak_memory_stats(self.config.device)
+            return peak / 2 ** 20
+
+        # kilobytes on linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+    def translate(self, x):
+        """
+        x is a batch of source sentences padded with PAD_ID,
+        returns generated sentences starting with BOS_ID.
+        with translation cache, only sentences not in the cache are generated.
+        """
+        x = x.to(self.config.device)
+        if self.translation_cache is None:
+            return self.__generate(x)
+
+        sources = [[id for id in ids if id != PAD_ID] for ids in x.tolist()]
+        outputs = [self.translation_cache.get(source) for source in sources]
+
+        # rows of each source not in the cache, the same sentences in the batch are generated once
+        misses = collections.defaultdict(list)
+        for i, output in enumerate(outputs):
+            if output is None:
+                misses[tuple(sources[i])].append(i)
+
+        if 0 < len(misses):
+            rows = [indices[0] for indices in misses.values()]
+            x = x[rows]
+            x = x[:, :(x != PAD_ID).sum(dim=1).max()]
+            generated = [TranslationCache.trim(ids) for ids in self.__generate(x).tolist()]
+
+            for indices, ids in zip(misses.values(), generated):
+                for i in indices:
+                    outputs[i] = ids
+            self.translation_cache.put([(sources[row], ids) for row, ids in zip(rows, generated)])
+
+        output = torch.full((len(outputs), max(map(len, outputs))), PAD_ID, dtype=torch.int)
+        for i, ids in enumerate(outputs):
+            output[i, :len(ids)] = torch.tensor(ids, dtype=torch.int)
+
+        return output.to(self.config.device)
+
+    def __get_translation_namespace(self):
+        """
+        hash of the model and settings generated sentences depend on
+        """
+        hasher = hashlib.sha256()
+        if self.loaded_model_path is not None:
+            with open(self.loaded_model_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), b''):
+                    hasher.update(chunk)
+        else:
+            for model in [self.encoder, self.decoder]:
+                for key, value in model.state_dict().items():
+                    if isinstance(value, torch.Tensor):
+                        hasher.update(key.encode('utf-8'))
+                        hasher.update(value.cpu().numpy().tobytes())
+
+        keys = ['beam_size', 'max_len_a', 'max_len_b', 'length_penalty', 'shortlist', 'shortlist_frequent', 'precision', 'attention_impl']
+        settings = {key: getattr(self.config, key) for key in keys}
+        hasher.update(json.dumps(settings, sort_keys=True).encode('utf-8'))
+
+        return hasher.hexdigest()
+
     def generate_test(self):
         self.encoder.eval()
         self.decoder.eval()
 
         data = MTDataset(self.config, 'test')
-        dataloader = torch.utils.data.DataLoader(data, batch_size=args.batch_size)
+        dataloader = torch.utils.data.DataLoader(data, batch_size=self.config.batch_size, collate_fn=MTDataset.collate)
 
         for x, _ in dataloader:
             x = x.to(self.config.device)
 
-            generated = self.__generate(x)
+            generated = self.translate(x)
 
             for i in range(x.size(0)):
                 print(' '.join([str(id) for id in x[i].tolist()]))
@@ -388,19 +1176,60 @@ class Trainer(object):
                 # print('output: {}'.format(generated[i].tolist()))
                 # print('')
 
-    def train(self):
+        if self.translation_cache is not None:
+            print('translation cache: {}'.format(self.translation_cache.get_stats()), file=sys.stderr)
+
+    def train(self, epoch):
         data_type = 'dummy' if self.config.train_test else 'train'
         data_train = MTDataset(self.config, data_type)
-        dataloader = torch.utils.data.DataLoader(data_train, batch_size=args.batch_size, shuffle=True)
 
-        print(f'start epoch {epoch}')
-        for x, y in dataloader:
+        # batches trained before the model was saved in the middle of this epoch are skipped without loading
+        skipped = self.config.epoch_batches if epoch == self.config.start_epoch else 0
+
+        # same seed in all processes to shard the same order of data
+        seed = self.config.seed + epoch
+        # dataloader draws from its own generator not to shift random state restored from the model
+        generator = torch.Generator().manual_seed(seed)
+        if 0 < self.config.max_tokens:
+            sampler = BucketBatchSampler(data_train.lengths(), self.config.max_tokens, seed=seed, rank=self.config.rank, world_size=self.config.world_size)
+            batches = list(sampler)[skipped:]
+            dataloader = torch.utils.data.DataLoader(data_train, batch_sampler=batches, collate_fn=MTDataset.collate, generator=generator)
+        else:
+            sampler = torch.utils.data.DistributedSampler(data_train, num_replicas=self.config.world_size, rank=self.config.rank, seed=seed)
+            indices = list(sampler)[skipped * self.config.batch_size:]
+            dataloader = torch.utils.data.DataLoader(data_train, batch_size=self.config.batch_size, sampler=indices, collate_fn=MTDataset.collate, generator=generator)
+
+        if self.config.profile and self.is_master and self.profile_end_steps is None:
+            self.__start_profiler()
+
+        if self.is_master:
+            print(f'start epoch {epoch}' + (f' from batch {skipped}' if 0 < skipped else ''))
+        for n_batches, (x, y) in enumerate(self.timer.iterate(dataloader, 'data'), skipped + 1):
             x = x.to(self.config.device)
             y = y.to(self.config.device)
-            self.step(x, y)
+            if not self.step(x, y):
+                continue
+
             self.step_end()
 
+            if 0 < self.config.save_interval and self.steps % self.config.save_interval == 0:
+                self.save(epoch - 1, [self.config.model_path], epoch_batches=n_batches)
+
     def evaluate(self, epoch=None, data_type=None):
+        """
+        with epoch, results are logged and the model is saved
+        """
+        metrics = self.compute_metrics(data_type)
+        if metrics is None:
+            return
+
+        if epoch is not None:
+            self.__report_metrics(metrics, epoch)
+
+        return metrics['bleu']
+
+    @torch.no_grad()
+    def compute_metrics(self, data_type=None):
         self.encoder.eval()
         self.decoder.eval()
 
@@ -412,98 +1241,364 @@ class Trainer(object):
             print('no evaluation data for data_type: {}'.format(data_type))
             return
 
-        dataloader = torch.utils.data.DataLoader(data, batch_size=args.batch_size)
+        # own generator keeps random state of training same whether evaluation runs in this process or not
+        dataloader = torch.utils.data.DataLoader(data, batch_size=self.config.batch_size, collate_fn=MTDataset.collate, generator=torch.Generator())
 
         n_words = 0
         xe_loss = 0
         n_valid = 0
-        refs = []
-        hyps = []
+        scorer = BleuScorer()
+        self.timer.pop(['generate_step'])
 
         for _, (x, y) in enumerate(dataloader):
             x = x.to(self.config.device)
             y = y.to(self.config.device)
 
-            scores = self.__predict(x, y, True)
+            # encoder output is shared by teacher forcing and generation
+            with self.timer.phase('encode'):
+                with self.autocast():
+                    enc_output = self.encoder(x)
 
-            y = y[:, 1:]
-            nwords = (y != PAD_ID).sum().item()
-            loss = self.criterion(scores, y, nwords)
+            with self.timer.phase('loss'):
+                with self.autocast():
+                    scores = self.__predict(x, y, True, enc_output)
 
-            n_words += nwords
-            xe_loss += loss.item() * nwords
-            n_valid += (scores.max(2)[1] == y).sum().item()
+                y = y[:, 1:]
+                nwords = (y != PAD_ID).sum().item()
+                loss = self.criterion(scores, y, nwords)
 
-            generated = self.__generate(x)
+                n_words += nwords
+                xe_loss += loss.item() * nwords
+                n_valid += (scores.max(2)[1] == y).sum().item()
+
+            with self.timer.phase('generate'):
+                generated = self.__generate(x, enc_output)
 
             assert len(generated) == len(y), 'size of generated and y are mismatched'
-            for i in range(len(generated)):
-                hyps.append([id.item() for id in generated[i, 1:] if id != PAD_ID])
-                refs.append([[id.item() for id in y[i] if id != PAD_ID]])
+            with self.timer.phase('bleu'):
+                scorer.add(generated[:, 1:], y)
+
+        phases = self.timer.pop(['encode', 'loss', 'generate', 'bleu', 'generate_step'])
+        times = {name: total for name, (total, _) in phases.items()}
+        step_time, n_steps = phases['generate_step']
+        times['generate_step'] = step_time / max(n_steps, 1)
 
         loss = xe_loss / n_words if n_words > 0 else 1e9
         ppl = np.exp(loss)
         acc = 100. * n_valid / n_words if n_words > 0 else 0.
 
-        bleu = corpus_bleu(refs, hyps) * 100.
-
-        if epoch is not None:
-            current_time = time.time()
-            self.writer.add_scalar('loss/eval', loss, epoch, current_time)
-            self.writer.add_scalar('ppl/eval', ppl, epoch, current_time)
-            self.writer.add_scalar('acc/eval', acc, epoch, current_time)
-            self.writer.add_scalar('bleu/eval', bleu, epoch, current_time)
-
-            self.__udpate_saved_model(bleu, epoch)
+        bleu = scorer.score() * 100.
 
         print('==============================')
         print('data_type: {}'.format(data_type))
         print('ppl: {:.2f}'.format(ppl))
         print('acc: {:.2f}'.format(acc))
         print('bleu: {:.2f}'.format(bleu))
+        print('time: ' + ', '.join(['{}: {:.2f}s'.format(key, value) for key, value in times.items() if key != 'generate_step']))
+        print('time per generation step: {:.2f}ms'.format(times['generate_step'] * 1000))
         print('==============================')
 
-    def __udpate_saved_model(self, bleu, epoch):
-        self.save(epoch, self.config.model_path)
+        return {
+            'loss': loss,
+            'ppl': ppl,
+            'acc': acc,
+            'bleu': bleu,
+            'times': times,
+        }
 
-        if len(self.bleu_history) == 0:
-            self.bleu_history.append(bleu)
+    def __report_metrics(self, metrics, epoch, checkpoint=None):
+        self.__add_scalar('loss/eval', metrics['loss'], epoch)
+        self.__add_scalar('ppl/eval', metrics['ppl'], epoch)
+        self.__add_scalar('acc/eval', metrics['acc'], epoch)
+        self.__add_scalar('bleu/eval', metrics['bleu'], epoch)
+        for name, value in metrics['times'].items():
+            self.__add_scalar(f'time/eval_{name}', value, epoch)
+
+        self.__udpate_saved_model(metrics['bleu'], epoch, checkpoint)
+
+    def evaluate_async(self, epoch):
+        """
+        weights at the end of epoch are evaluated in background process and training goes on meanwhile.
+        the checkpoint of epoch is saved to model_path now and kept to save it as the best model when its result arrives
+        """
+        # checkpoints are kept in memory until their results arrive, so only one evaluation runs at a time
+        if 0 < len(self.pending_evaluations):
+            print('wait for evaluation of epoch {}'.format(', '.join(map(str, self.pending_evaluations))))
+            self.collect_evaluations(wait=True)
+
+        checkpoint = self.get_checkpoint(epoch)
+        data, _ = checkpoint
+
+        # weights are moved to shared memory before saving starts, then they are sent to the worker without copy
+        for state in [data['encoder'], data['decoder']]:
+            for value in state.values():
+                value.share_memory_()
+
+        self.save(epoch, [self.config.model_path], checkpoint=checkpoint)
+
+        if self.evaluator is None:
+            self.evaluator = AsyncEvaluator(self.config)
+
+        self.pending_evaluations[epoch] = checkpoint
+        self.evaluator.submit(epoch, data['encoder'], data['decoder'])
+
+    def collect_evaluations(self, wait=False):
+        """
+        reports results of background evaluations arrived, waits for all of them with wait
+        """
+        if self.evaluator is None:
             return
 
-        previous_best = self.bleu_history[0]
-        if bleu <= previous_best:
+        for epoch, metrics in self.evaluator.get_results(wait):
+            checkpoint = self.pending_evaluations.pop(epoch)
+            if metrics is not None:
+                print(f'evaluation of epoch {epoch} is finished')
+                self.__report_metrics(metrics, epoch, checkpoint)
+
+    def close_evaluator(self):
+        if self.evaluator is not None:
+            self.evaluator.close()
+            self.evaluator = None
+
+    def compare_shortlist(self, data_type):
+        """
+        evaluates with shortlist and with full vocabulary
+        """
+        bleu = self.evaluate(data_type=data_type)
+        shortlist, self.shortlist = self.shortlist, None
+        full_bleu = self.evaluate(data_type=data_type)
+        self.shortlist = shortlist
+
+        if bleu is not None:
+            print('bleu: {:.2f} with full vocabulary, {:.2f} with shortlist ({:+.2f})'.format(full_bleu, bleu, bleu - full_bleu))
+
+    def __udpate_saved_model(self, bleu, epoch, checkpoint=None):
+        """
+        checkpoint is given by background evaluation, it has been saved to model_path already
+        """
+        paths = [self.config.model_path] if checkpoint is None else []
+
+        if len(self.bleu_history) == 0 or bleu <= self.bleu_history[0]:
             self.bleu_history.append(bleu)
-            return
+        else:
+            self.bleu_history = [bleu]
+            paths.append(self.config.best_model_path)
 
-        self.bleu_history = [bleu]
-        self.save(epoch, self.config.best_model_path)
+        if 0 < len(paths):
+            self.save(epoch, paths, checkpoint=checkpoint)
+
+        # model_path was saved before the result arrived, its history is updated for resuming
+        if checkpoint is not None:
+            self.checkpoint.update_header(self.config.model_path, {'bleu_history': list(self.bleu_history)})
 
     def is_early_stopping(self):
-        return self.config.early_stopping_threshold < len(self.bleu_history)
+        is_early_stopping = self.config.early_stopping_threshold < len(self.bleu_history)
+
+        # history is updated only in master process
+        if 1 < self.config.world_size:
+            flag = torch.tensor([int(is_early_stopping)], device=self.config.device)
+            dist.broadcast(flag, 0)
+            is_early_stopping = bool(flag.item())
+
+        return is_early_stopping
 
 class LabelSmoothing(nn.Module):
+    """
+    KL divergence from the smoothed distribution, where the target word has 1 - smoothing
+    and the other words except PAD_ID share smoothing. it is computed in closed form
+    from log probabilities without materializing the distribution of vocab_size for each word.
+    """
     def __init__(self, size, smoothing):
         super(LabelSmoothing, self).__init__()
-        self.criterion = nn.KLDivLoss(reduction='sum')
         self.smoothing = smoothing
         self.size = size
 
-    def forward(self, x, target, nwords):
-        x = x.contiguous().view(-1, self.size)
-        target = target.contiguous().view(-1)
-
-        true_dist = x.data.clone()
-        true_dist.fill_(self.smoothing / (self.size - 2))
-        true_dist.scatter_(1, target.unsqueeze(1).to(dtype=torch.long), 1.0 - self.smoothing)
-        true_dist[:, PAD_ID] = 0
+        self.confidence = 1.0 - smoothing
+        self.others = smoothing / (size - 2)
 
-        mask = torch.nonzero(target.data == PAD_ID)
-        if mask.dim() > 0:
-            true_dist.index_fill_(0, mask.squeeze(), 0.0)
+        # sum of p * log(p) of the smoothed distribution, 0 * log(0) is 0
+        def plogp(p):
+            return p * math.log(p) if 0 < p else 0.0
+        self.negative_entropy = plogp(self.confidence) + (size - 2) * plogp(self.others)
 
-        return self.criterion(x, true_dist.requires_grad_(False)) / nwords
+    def forward(self, x, target, nwords):
+        x = x.contiguous().view(-1, self.size)
+        target = target.contiguous().view(-1, 1).to(dtype=torch.long)
+
+        x_target = x.gather(1, target).squeeze(1)
+        x_others = x.sum(dim=1) - x_target - x[:, PAD_ID]
+
+        loss = self.negative_entropy - self.confidence * x_target - self.others * x_others
+        loss = loss.masked_fill(target.squeeze(1) == PAD_ID, 0.0)
+
+        return loss.sum() / nwords
+
+class BleuScorer(object):
+    """
+    corpus BLEU accumulated from batches of token id tensors.
+    n-grams of all sentences in a batch are counted at once with torch.unique,
+    the score is the same as corpus_bleu of nltk with one reference and default weights.
+    """
+    def __init__(self, max_n=4):
+        self.max_n = max_n
+        self.numerators = [0] * max_n
+        self.denominators = [0] * max_n
+        self.hyp_len = 0
+        self.ref_len = 0
+
+    def add(self, hyps, refs):
+        """
+        hyps and refs are (batch, length) tensors, PAD_ID in them are ignored
+        """
+        hyps, hyp_lengths = BleuScorer.__compact(hyps.to(dtype=torch.long).cpu())
+        refs, ref_lengths = BleuScorer.__compact(refs.to(dtype=torch.long).cpu())
+
+        self.hyp_len += hyp_lengths.sum().item()
+        self.ref_len += ref_lengths.sum().item()
+
+        for n in range(1, self.max_n + 1):
+            hyp_ngrams, hyp_counts = BleuScorer.__get_ngrams(hyps, hyp_lengths, n)
+            ref_ngrams, _ = BleuScorer.__get_ngrams(refs, ref_lengths, n)
+
+            ngrams = torch.cat([hyp_ngrams, ref_ngrams])
+            _, inverse = torch.unique(ngrams, dim=0, return_inverse=True)
+            n_unique = inverse.max().item() + 1 if 0 < len(inverse) else 0
+            hyp_matched = torch.bincount(inverse[:len(hyp_ngrams)], minlength=n_unique)
+            ref_matched = torch.bincount(inverse[len(hyp_ngrams):], minlength=n_unique)
+
+            # counts of n-grams in hypothesis are clipped by counts in reference
+            self.numerators[n-1] += torch.min(hyp_matched, ref_matched).sum().item()
+            self.denominators[n-1] += hyp_counts.clamp(min=1).sum().item()
+
+    def score(self):
+        if self.numerators[0] == 0:
+            return 0.
+
+        # no smoothing, precision without matches makes the score almost 0 as nltk does
+        precisions = [n / d if 0 < n else sys.float_info.min for n, d in zip(self.numerators, self.denominators)]
+        log_precision = math.fsum(math.log(p) / self.max_n for p in precisions)
+
+        if self.ref_len < self.hyp_len:
+            brevity_penalty = 1.
+        elif self.hyp_len == 0:
+            brevity_penalty = 0.
+        else:
+            brevity_penalty = math.exp(1 - self.ref_len / self.hyp_len)
+
+        return brevity_penalty * math.exp(log_precision)
+
+    @staticmethod
+    def __compact(x):
+        """
+        moves PAD_ID to the end of sentences keeping order of others
+        """
+        is_pad = x == PAD_ID
+        _, order = is_pad.to(dtype=torch.int8).sort(dim=1, stable=True)
+        return x.gather(1, order), (~is_pad).sum(dim=1)
+
+    @staticmethod
+    def __get_ngrams(x, lengths, n):
+        """
+        returns n-grams prefixed by index of sentences and number of n-grams of each sentence
+        """
+        batch_size, n_words = x.shape
+        if n_words < n:
+            return x.new_empty((0, n + 1)), torch.zeros_like(lengths)
+
+        ngrams = x.unfold(1, n, 1)
+        is_valid = torch.arange(ngrams.size(1)).unsqueeze(0) + n <= lengths.unsqueeze(1)
+        sentence_ids = torch.arange(batch_size).unsqueeze(1).expand(-1, ngrams.size(1))
+        ngrams = torch.cat([sentence_ids.unsqueeze(-1), ngrams], dim=-1)
+
+        return ngrams[is_valid], is_valid.sum(dim=1)
+
+class Shortlist(object):
+    """
+    target words that can be generated are restricted to candidates of source words in the batch
+    and the most frequent target words. candidates of a source word are target words that have
+    the highest dice coefficient of co-occurrence with it in sentence pairs of the training data.
+    """
+    def __init__(self, candidates, frequent, device):
+        self.candidates = torch.from_numpy(candidates).to(device)
+        self.frequent = torch.from_numpy(frequent).to(device)
+        self.eos = torch.tensor([EOS_ID], device=device)
+
+    def get_vocab(self, x):
+        """
+        returns sorted target words for the batch of source sentences x
+        """
+        candidates = self.candidates[x[x != PAD_ID].unique()].view(-1)
+        return torch.cat([candidates[0 <= candidates], self.frequent, self.eos]).unique()
+
+    @staticmethod
+    def path(config):
+        return f'{config.dataroot}/train.{config.src}-{config.tgt}.shortlist{config.shortlist}_{config.shortlist_frequent}.npz'
+
+    @staticmethod
+    def load(config):
+        path = Shortlist.path(config)
+
+        # in distributed training, only master process builds it and the others wait for it
+        if (config.world_size == 1 or config.rank == 0) and not os.path.isfile(path):
+            Shortlist.build(config, path)
+        if 1 < config.world_size:
+            dist.barrier()
+
+        loaded = np.load(path)
+        return Shortlist(loaded['candidates'], loaded['frequent'], config.device)
+
+    @staticmethod
+    def build(config, path):
+        data = MTDataset(config, 'train')
+        assert len(data) != 0, 'training data is needed to build shortlist'
+
+        def incidence(lang):
+            # sentences x words matrix, 1 if the word appears in the sentence
+            tokens, offsets = data.data[lang]
+            sent_ids = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            indices = torch.from_numpy(np.stack([sent_ids, np.asarray(tokens, dtype=np.int64)]))
+            matrix = torch.sparse_coo_tensor(indices, torch.ones(indices.size(1)), (len(offsets) - 1, config.vocab_size)).coalesce()
+            return torch.sparse_coo_tensor(matrix.indices(), torch.ones_like(matrix.values()), matrix.shape)
+
+        src, tgt = incidence(config.src), incidence(config.tgt)
+        src_counts = torch.sparse.sum(src, dim=0).to_dense()
+        tgt_counts = torch.sparse.sum(tgt, dim=0).to_dense()
+
+        # number of sentence pairs each pair of source and target words appears in
+        cooccurrence = torch.sparse.mm(src.t(), tgt).coalesce()
+        src_ids, tgt_ids = cooccurrence.indices().numpy()
+        dice = (2 * cooccurrence.values() / (src_counts[src_ids] + tgt_counts[tgt_ids])).numpy()
+
+        # BOS_ID is in all sentences but never generated
+        is_word = (tgt_ids != BOS_ID) & (tgt_ids != PAD_ID)
+        src_ids, tgt_ids, dice = src_ids[is_word], tgt_ids[is_word], dice[is_word]
+
+        # rank of target words in each source word by dice coefficient
+        order = np.lexsort((-dice, src_ids))
+        src_ids, tgt_ids = src_ids[order], tgt_ids[order]
+        ranks = np.arange(len(src_ids)) - np.searchsorted(src_ids, src_ids)
+
+        is_candidate = ranks < config.shortlist
+        candidates = np.full((config.vocab_size, config.shortlist), -1, dtype=np.int64)
+        candidates[src_ids[is_candidate], ranks[is_candidate]] = tgt_ids[is_candidate]
+
+        tgt_counts[[BOS_ID, PAD_ID]] = 0
+        n_frequent = min(config.shortlist_frequent, config.vocab_size)
+        frequent = tgt_counts.topk(n_frequent)[1].numpy()
+
+        # written atomically so that a crash while writing does not leave a broken file
+        with open(f'{path}.tmp', 'wb') as f:
+            np.savez(f, candidates=candidates, frequent=frequent)
+        os.replace(f'{path}.tmp', path)
+        print(f'save shortlist to {path}')
 
 class MTDataset(torch.utils.data.Dataset):
+    """
+    sentences of a language are kept as a flat token array and offsets of each sentence.
+    binary files made by binarize are opened with memory map, id text files are also supported.
+    """
+    CHUNK_LINES = 100000
+
     def __init__(self, config, type):
         self.config = config
         self.data = {} 
@@ -515,35 +1610,50 @@ class MTDataset(torch.utils.data.Dataset):
         dataroot = config.dataroot
         for lang in [config.src, config.tgt]:
             path = "{}/{}.{}".format(dataroot, type, lang)
-            if not os.path.isfile(path):
+            tokens_path, offsets_path = MTDataset.binary_paths(path)
+            if os.path.isfile(tokens_path) and os.path.isfile(offsets_path):
+                tokens = np.load(tokens_path, mmap_mode='r')
+                offsets = np.load(offsets_path, mmap_mode='r')
+            elif os.path.isfile(path):
+                tokens, offsets = MTDataset.__read_text(path)
+            else:
                 continue
 
-            with open(path, 'r') as f:
-                lines = f.read().splitlines()
-                data = np.empty((len(lines), self.config.n_words))
-                data.fill(PAD_ID)
-                for row in range(len(lines)):
-                    line = lines[row]
-                    if not line:
-                        continue
-
-                    array = line.split(' ')
-                    word_count = len(array)
-                    assert word_count <= self.config.n_words, f'the sentence that has many words we expected. row: {row}, words: {word_count}'
-
-                    for col in range(len(array)):
-                        data[row][col] = int(array[col])
+            lengths = np.diff(offsets)
+            if 0 < len(lengths):
+                row = int(lengths.argmax())
+                assert lengths[row] <= self.config.n_words, f'the sentence that has many words we expected. row: {row}, words: {lengths[row]}'
 
-            self.data[lang] = torch.from_numpy(data).to(dtype=torch.int)
+            self.data[lang] = (tokens, offsets)
 
     def __len__(self):
         if self.config.src in self.data:
-            return len(self.data[self.config.src])
+            return len(self.data[self.config.src][1]) - 1
 
         return 0
 
     def __getitem__(self, idx):
-        return (self.data[self.config.src][idx], self.data[self.config.tgt][idx])
+        return (self.__get_sentence(self.config.src, idx), self.__get_sentence(self.config.tgt, idx))
+
+    def __get_sentence(self, lang, idx):
+        tokens, offsets = self.data[lang]
+        return torch.from_numpy(np.array(tokens[offsets[idx]:offsets[idx+1]], dtype=np.int64))
+
+    @staticmethod
+    def collate(batch):
+        """
+        pads sentences to the longest one in the batch
+        """
+        x, y = zip(*batch)
+        pad = torch.nn.utils.rnn.pad_sequence
+        return pad(x, batch_first=True, padding_value=PAD_ID), pad(y, batch_first=True, padding_value=PAD_ID)
+
+    def lengths(self):
+        """
+        number of tokens of each pair of sentences, the longer one of source and target
+        """
+        lengths = [np.diff(offsets) for _, offsets in self.data.values()]
+        return np.stack(lengths).max(axis=0)
 
     def __init_with_dummy(self):
         data_size = 1000
@@ -560,10 +1670,662 @@ class MTDataset(torch.utils.data.Dataset):
             data[i][index+1:] = PAD_ID
 
         data[:, 0] = BOS_ID
-        data = torch.from_numpy(data).to(self.config.device, dtype=torch.int)
 
-        self.data[self.config.src] = data.clone()
-        self.data[self.config.tgt] = data
+        tokens = data[data != PAD_ID]
+        offsets = np.concatenate([[0], np.cumsum(eos_indexes + 1)])
+
+        self.data[self.config.src] = (tokens.copy(), offsets)
+        self.data[self.config.tgt] = (tokens, offsets)
+
+    @staticmethod
+    def binary_paths(path):
+        return f'{path}.tokens.npy', f'{path}.offsets.npy'
+
+    @staticmethod
+    def __read_chunks(path):
+        with open(path, 'r') as f:
+            while True:
+                lines = list(itertools.islice(f, MTDataset.CHUNK_LINES))
+                if not lines:
+                    return
+
+                lengths = np.array([len(line.split()) for line in lines], dtype=np.int64)
+                tokens = np.array(' '.join(lines).split(), dtype=np.int64)
+                yield tokens, lengths
+
+    @staticmethod
+    def __read_text(path):
+        tokens = []
+        lengths = []
+        for chunk_tokens, chunk_lengths in MTDataset.__read_chunks(path):
+            tokens.append(chunk_tokens)
+            lengths.append(chunk_lengths)
+
+        tokens = np.concatenate(tokens) if tokens else np.empty(0, dtype=np.int64)
+        lengths = np.concatenate(lengths) if lengths else np.empty(0, dtype=np.int64)
+
+        return tokens, np.concatenate([[0], np.cumsum(lengths)])
+
+    @staticmethod
+    def binarize(config):
+        """
+        converts id text files of train, valid and test to binary files MTDataset can open with memory map.
+        tokens are stored as int16 when vocab_size allows, offsets of sentences as int64.
+        """
+        dtype = np.int16 if config.vocab_size <= np.iinfo(np.int16).max + 1 else np.int32
+
+        for type in ['train', 'valid', 'test']:
+            for lang in [config.src, config.tgt]:
+                path = "{}/{}.{}".format(config.dataroot, type, lang)
+                if not os.path.isfile(path):
+                    continue
+
+                start_time = time.time()
+
+                # count first to write into memory mapped arrays with fixed size
+                n_lines = 0
+                n_tokens = 0
+                for _, lengths in MTDataset.__read_chunks(path):
+                    n_lines += len(lengths)
+                    n_tokens += int(lengths.sum())
+
+                tokens_path, offsets_path = MTDataset.binary_paths(path)
+                tokens = np.lib.format.open_memmap(tokens_path, mode='w+', dtype=dtype, shape=(n_tokens,))
+                offsets = np.lib.format.open_memmap(offsets_path, mode='w+', dtype=np.int64, shape=(n_lines + 1,))
+                offsets[0] = 0
+
+                line = 0
+                for chunk_tokens, chunk_lengths in MTDataset.__read_chunks(path):
+                    assert len(chunk_tokens) == 0 or chunk_tokens.max() < config.vocab_size, f'token id must be less than vocab_size {config.vocab_size}: {path}'
+                    start = offsets[line]
+                    tokens[start:start + len(chunk_tokens)] = chunk_tokens
+                    offsets[line + 1:line + 1 + len(chunk_lengths)] = start + np.cumsum(chunk_lengths)
+                    line += len(chunk_lengths)
+
+                tokens.flush()
+                offsets.flush()
+                print('binarize {}: {} sentences, {} tokens, {:.1f} sec'.format(path, n_lines, n_tokens, time.time() - start_time))
+
+class BucketBatchSampler(torch.utils.data.Sampler):
+    """
+    batches consist of sentences that have similar lengths,
+    number of tokens including padding in a batch is kept under max_tokens.
+    """
+    def __init__(self, lengths, max_tokens, shuffle=True, seed=0, rank=0, world_size=1):
+        self.lengths = np.asarray(lengths)
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.random = np.random.RandomState(seed)
+        self.rank = rank
+        self.world_size = world_size
+        self.batches = self.__make_batches()
+
+    def __make_batches(self):
+        # random tie break changes members of batches every epoch
+        tie_break = self.random.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        indexes = np.lexsort((tie_break, self.lengths))
+
+        batches = []
+        batch = []
+        for index in indexes:
+            # lengths are sorted, so the current one is the longest in the batch
+            if batch and self.max_tokens < (len(batch) + 1) * self.lengths[index]:
+                batches.append(batch)
+                batch = []
+            batch.append(int(index))
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+    def __iter__(self):
+        batches = self.batches
+        if self.shuffle:
+            self.random.shuffle(batches)
+
+        # every process takes the same number of batches
+        n_batches = len(self)
+        return iter(batches[self.rank::self.world_size][:n_batches])
+
+    def __len__(self):
+        return len(self.batches) // self.world_size
+
+class TranslationCache(object):
+    """
+    generated sentences keyed by source ids, kept in memory with LRU eviction up to max_size sentences
+    and in sqlite that survives restarts when db_path is given.
+    namespace identifies the model and decoding settings, entries of the others are never returned.
+    """
+    def __init__(self, namespace, max_size, db_path=None):
+        self.namespace = namespace
+        self.max_size = max_size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = collections.Counter()
+
+        self.db = None
+        if db_path is not None:
+            self.db = sqlite3.connect(db_path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS translations (namespace TEXT, source TEXT, output TEXT, PRIMARY KEY (namespace, source))')
+            self.db.commit()
+
+    def get(self, source):
+        """
+        returns generated ids of source ids or None
+        """
+        key = ' '.join(map(str, source))
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key]
+
+            if self.db is not None:
+                row = self.db.execute('SELECT output FROM translations WHERE namespace = ? AND source = ?', (self.namespace, key)).fetchone()
+                if row is not None:
+                    output = [int(id) for id in row[0].split()]
+                    self.__put_memory(key, output)
+                    self.stats['disk_hits'] += 1
+                    return output
+
+            self.stats['misses'] += 1
+            return None
+
+    def put(self, items):
+        """
+        items are pairs of source ids and generated ids
+        """
+        items = [(' '.join(map(str, source)), output) for source, output in items]
+        with self.lock:
+            for key, output in items:
+                self.__put_memory(key, output)
+
+            if self.db is not None:
+                rows = [(self.namespace, key, ' '.join(map(str, output))) for key, output in items]
+                self.db.executemany('INSERT OR REPLACE INTO translations VALUES (?, ?, ?)', rows)
+                self.db.commit()
+
+    def get_stats(self):
+        with self.lock:
+            n_hits = self.stats['hits'] + self.stats['disk_hits']
+            n_lookups = n_hits + self.stats['misses']
+            return {
+                'hits': self.stats['hits'],
+                'disk_hits': self.stats['disk_hits'],
+                'misses': self.stats['misses'],
+                'hit_rate': n_hits / n_lookups if 0 < n_lookups else 0,
+                'size': len(self.entries),
+            }
+
+    def __put_memory(self, key, output):
+        if self.max_size <= 0:
+            return
+
+        self.entries[key] = output
+        self.entries.move_to_end(key)
+        while self.max_size < len(self.entries):
+            self.entries.popitem(last=False)
+
+    @staticmethod
+    def trim(ids):
+        """
+        removes ids after EOS_ID and padding
+        """
+        for i, id in enumerate(ids):
+            if id == EOS_ID:
+                return ids[:i+1]
+            if id == PAD_ID:
+                return ids[:i]
+
+        return ids
+
+class TranslationServer(object):
+    """
+    http server that keeps model loaded and translates sentences of token ids.
+    requests arriving within max_latency_ms from the first one are translated
+    together in a batch of up to max_batch_size sentences.
+
+    POST /translate {"sentences": [[1, 5, 6, 2], ...]} returns {"sentences": [[7, 8], ...], "latency_ms": ...}
+    GET /stats returns latency and batch size stats
+    """
+    N_LATENCIES = 1000
+    REQUEST_QUEUE_SIZE = 128
+
+    def __init__(self, trainer, config):
+        self.trainer = trainer
+        self.config = config
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.latencies = collections.deque(maxlen=TranslationServer.N_LATENCIES)
+        self.batch_sizes = collections.Counter()
+        self.n_requests = 0
+
+    def serve(self):
+        threading.Thread(target=self.__run_batches, daemon=True).start()
+
+        server = ThreadingHTTPServer((self.config.host, self.config.port), TranslationRequestHandler, bind_and_activate=False)
+        server.translation_server = self
+        server.request_queue_size = TranslationServer.REQUEST_QUEUE_SIZE
+        server.server_bind()
+        server.server_activate()
+        print(f'serving on {self.config.host}:{self.config.port}')
+        server.serve_forever()
+
+    def translate(self, sentences):
+        """
+        sentences are validated before queued, since an invalid one would fail all sentences batched with it
+        """
+        if not isinstance(sentences, list):
+            raise ValueError('sentences must be a list of lists of word ids')
+        for sentence in sentences:
+            if not isinstance(sentence, list) or not 0 < len(sentence) <= self.config.n_words:
+                raise ValueError(f'each sentence must be a list of 1 to {self.config.n_words} word ids')
+            for id in sentence:
+                if type(id) is not int or not 0 <= id < self.config.vocab_size:
+                    raise ValueError(f'word ids must be integers in 0 to {self.config.vocab_size - 1}')
+
+        start_time = time.time()
+        futures = []
+        for sentence in sentences:
+            future = Future()
+            self.queue.put((torch.tensor(sentence, dtype=torch.long), future))
+            futures.append(future)
+
+        results = [future.result() for future in futures]
+        latency = time.time() - start_time
+
+        with self.lock:
+            self.n_requests += 1
+            self.latencies.append(latency)
+
+        return results, latency
+
+    def get_stats(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1000
+            batch_sizes = dict(self.batch_sizes)
+            n_requests = self.n_requests
+
+        n_batches = sum(batch_sizes.values())
+        n_sentences = sum(size * count for size, count in batch_sizes.items())
+
+        return {
+            'requests': n_requests,
+            'cache': self.trainer.translation_cache.get_stats() if self.trainer.translation_cache is not None else None,
+            'batches': n_batches,
+            'mean_batch_size': n_sentences / n_batches if 0 < n_batches else 0,
+            'batch_sizes': {str(size): batch_sizes[size] for size in sorted(batch_sizes)},
+            'latency_ms': {
+                'mean': float(latencies.mean()) if 0 < len(latencies) else 0,
+                'p50': float(np.percentile(latencies, 50)) if 0 < len(latencies) else 0,
+                'p95': float(np.percentile(latencies, 95)) if 0 < len(latencies) else 0,
+                'max': float(latencies.max()) if 0 < len(latencies) else 0,
+            },
+        }
+
+    def __run_batches(self):
+        while True:
+            requests = [self.queue.get()]
+            deadline = time.time() + self.config.max_latency_ms / 1000
+
+            while len(requests) < self.config.max_batch_size:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    requests.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            sentences, futures = zip(*requests)
+            x = torch.nn.utils.rnn.pad_sequence(sentences, batch_first=True, padding_value=PAD_ID)
+
+            try:
+                generated = self.trainer.translate(x).tolist()
+            except Exception as e:
+                for future in futures:
+                    future.set_exception(e)
+                continue
+
+            with self.lock:
+                self.batch_sizes[len(requests)] += 1
+
+            for future, ids in zip(futures, generated):
+                future.set_result(TranslationServer.strip(ids))
+
+    @staticmethod
+    def strip(ids):
+        """
+        removes BOS_ID and ids from EOS_ID
+        """
+        ids = ids[1:]
+        for i, id in enumerate(ids):
+            if id == EOS_ID or id == PAD_ID:
+                return ids[:i]
+
+        return ids
+
+class TextTranslator(object):
+    """
+    translates raw text lines with sentencepiece model loaded in this process.
+    lines are read in chunks of chunk_size, translated in batches of similar lengths
+    and written in input order. tokenized ids of recent lines are kept to reuse for the same lines.
+    with workers, batches are translated by worker processes that load the model once.
+    """
+    MAX_TOKENIZED_LINES = 100000
+
+    def __init__(self, trainer, config):
+        import sentencepiece
+
+        self.trainer = trainer
+        self.config = config
+        self.processor = sentencepiece.SentencePieceProcessor(model_file=config.spm_model)
+        self.tokenized = collections.OrderedDict()
+        self.workers = []
+
+        if 1 < config.workers:
+            self.__start_workers()
+
+    def __start_workers(self):
+        # workers are not the master process, they write no logs.
+        # translation cache is looked up and updated only by this process, so workers do not open it
+        config = copy.copy(self.config)
+        config.rank = None
+        config.translation_cache_size = 0
+        config.translation_cache_db = None
+
+        context = mp.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+
+        threads = self.config.threads_per_worker
+        if threads is None:
+            threads = max(1, os.cpu_count() // self.config.workers)
+
+        start_time = time.time()
+        for _ in range(self.config.workers):
+            worker = context.Process(target=run_translation_worker, args=(config, threads, self.tasks, self.results), daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+        for _ in self.workers:
+            _, _, error = self.results.get()
+            if error is not None:
+                raise RuntimeError(f'translation worker failed\n{error}')
+        print('start {} workers with {} threads in {:.1f}s'.format(self.config.workers, threads, time.time() - start_time), file=sys.stderr)
+
+    def close(self):
+        for _ in self.workers:
+            self.tasks.put(None)
+        for worker in self.workers:
+            worker.join()
+
+    def translate_file(self, input, output):
+        start_time = time.time()
+        n_lines = 0
+
+        lines = (line.rstrip('\n') for line in input)
+        while True:
+            chunk = list(itertools.islice(lines, self.config.chunk_size))
+            if len(chunk) == 0:
+                break
+
+            for line in self.translate(chunk):
+                output.write(line + '\n')
+            output.flush()
+
+            n_lines += len(chunk)
+            elapsed_time = time.time() - start_time
+            print('translated {} lines, {:.1f} lines/sec'.format(n_lines, n_lines / elapsed_time), file=sys.stderr)
+
+        self.close()
+
+    def translate(self, lines):
+        sentences = self.__tokenize(lines)
+        translated = [[] for _ in sentences]
+
+        # empty lines are left empty
+        rows = [i for i, line in enumerate(lines) if line.strip() != '']
+
+        # without workers, trainer.translate looks up the cache by itself
+        cache = self.trainer.translation_cache if 0 < len(self.workers) else None
+        if cache is not None:
+            outputs = {i: cache.get(sentences[i]) for i in rows}
+            for i, output in outputs.items():
+                if output is not None:
+                    translated[i] = TranslationServer.strip(output)
+            rows = [i for i in rows if outputs[i] is None]
+
+        rows.sort(key=lambda i: len(sentences[i]))
+
+        batch_size = self.config.batch_size
+        batches = [rows[start:start+batch_size] for start in range(0, len(rows), batch_size)]
+        generated = self.__translate_batches([[sentences[i] for i in batch] for batch in batches])
+
+        for batch, batch_generated in zip(batches, generated):
+            for i, ids in zip(batch, batch_generated):
+                translated[i] = TranslationServer.strip(ids)
+
+            if cache is not None:
+                cache.put([(sentences[i], TranslationCache.trim(ids)) for i, ids in zip(batch, batch_generated)])
+
+        return self.processor.decode(translated)
+
+    def __translate_batches(self, batches):
+        if len(self.workers) == 0:
+            return [TextTranslator.translate_batch(self.trainer, batch) for batch in batches]
+
+        for batch_id, batch in enumerate(batches):
+            self.tasks.put((batch_id, batch))
+
+        # results arrive in order of completion
+        generated = [None] * len(batches)
+        for _ in batches:
+            batch_id, batch_generated, error = self.results.get()
+            if error is not None:
+                raise RuntimeError(f'translation worker failed\n{error}')
+            generated[batch_id] = batch_generated
+
+        return generated
+
+    @staticmethod
+    def translate_batch(trainer, sentences):
+        x = torch.nn.utils.rnn.pad_sequence([torch.tensor(ids) for ids in sentences], batch_first=True, padding_value=PAD_ID)
+        return trainer.translate(x).tolist()
+
+    def __tokenize(self, lines):
+        """
+        returns ids of lines with BOS_ID and EOS_ID, words beyond n_words are truncated
+        """
+        sentences = {}
+        for line in lines:
+            if line in self.tokenized and line not in sentences:
+                self.tokenized.move_to_end(line)
+                sentences[line] = self.tokenized[line]
+
+        new_lines = [line for line in dict.fromkeys(lines) if line not in sentences]
+        if 0 < len(new_lines):
+            max_words = self.config.n_words - 2
+            for line, ids in zip(new_lines, self.processor.encode(new_lines, out_type=int)):
+                sentences[line] = [BOS_ID] + ids[:max_words] + [EOS_ID]
+                self.tokenized[line] = sentences[line]
+
+            while TextTranslator.MAX_TOKENIZED_LINES < len(self.tokenized):
+                self.tokenized.popitem(last=False)
+
+        return [sentences[line] for line in lines]
+
+class TranslationRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/stats':
+            self.send_error(404)
+            return
+
+        self.__send_json(self.server.translation_server.get_stats())
+
+    def do_POST(self):
+        if self.path != '/translate':
+            self.send_error(404)
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            sentences = json.loads(self.rfile.read(length))['sentences']
+            results, latency = self.server.translation_server.translate(sentences)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_error(400, str(e))
+            return
+        except Exception as e:
+            self.send_error(500, str(e))
+            return
+
+        self.__send_json({'sentences': results, 'latency_ms': latency * 1000})
+
+    def __send_json(self, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class AsyncEvaluator(object):
+    """
+    evaluates snapshots of weights in a background process that loads the model once.
+    snapshots are evaluated in submitted order, results are returned by get_results.
+    """
+    def __init__(self, config):
+        # the process is not a rank of training, it writes neither logs nor models
+        config = copy.copy(config)
+        config.world_size = 1
+        config.rank = None
+        config.profile = False
+
+        # training keeps the other cores
+        threads = config.eval_threads
+        if threads is None:
+            threads = max(1, os.cpu_count() // 4)
+
+        context = mp.get_context('spawn')
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.n_pending = 0
+
+        self.worker = context.Process(target=run_evaluation_worker, args=(config, threads, self.tasks, self.results), daemon=True)
+        self.worker.start()
+
+    def submit(self, epoch, encoder, decoder):
+        """
+        tensors of encoder and decoder must not be updated until the result arrives, because queue sends them in background thread
+        """
+        self.tasks.put((epoch, encoder, decoder))
+        self.n_pending += 1
+
+    def get_results(self, wait=False):
+        """
+        returns list of (epoch, metrics), metrics is None when there is no evaluation data
+        """
+        results = []
+        while 0 < self.n_pending:
+            try:
+                epoch, metrics, error = self.results.get(block=wait)
+            except queue.Empty:
+                break
+
+            self.n_pending -= 1
+            if error is not None:
+                raise RuntimeError(f'evaluation worker failed\n{error}')
+            results.append((epoch, metrics))
+
+        return results
+
+    def close(self):
+        self.tasks.put(None)
+        self.worker.join()
+
+class Checkpoint(object):
+    """
+    checkpoints are written in a background thread from a snapshot on cpu not to stop training.
+    hyperparameters and progress are also written to a json header next to the checkpoint
+    so that they are read without loading tensors.
+    """
+    def __init__(self):
+        self.thread = None
+
+    @staticmethod
+    def header_path(path):
+        return f'{path}.json'
+
+    @staticmethod
+    def read_header(path):
+        header_path = Checkpoint.header_path(path)
+        if os.path.isfile(header_path):
+            with open(header_path) as f:
+                return json.load(f)
+
+        # checkpoints saved before headers were introduced
+        loaded = torch.load(path, map_location='cpu', weights_only=False)
+        return {key: value for key, value in loaded.items() if not isinstance(value, dict)}
+
+    @staticmethod
+    def snapshot(data):
+        """
+        copies tensors in nested dicts and lists to cpu because training goes on updating them
+        """
+        if isinstance(data, torch.Tensor):
+            return data.detach().to('cpu', copy=True)
+        if isinstance(data, dict):
+            return {key: Checkpoint.snapshot(value) for key, value in data.items()}
+        if isinstance(data, (list, tuple)):
+            return type(data)(Checkpoint.snapshot(value) for value in data)
+        return data
+
+    def save(self, data, header, paths):
+        """
+        data is written to the first path and copied to the others.
+        only one save runs at a time, the previous one is waited for.
+        """
+        self.wait()
+        self.thread = threading.Thread(target=Checkpoint.__write, args=(data, header, paths))
+        self.thread.start()
+
+    def update_header(self, path, values):
+        """
+        rewrites values in the header of the checkpoint saved to path, after the running save
+        """
+        self.wait()
+        header = Checkpoint.read_header(path)
+        header.update(values)
+        Checkpoint.__write_header(header, path)
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    @staticmethod
+    def __write(data, header, paths):
+        # files are replaced atomically so that a crash while saving does not break the previous checkpoint
+        tmp_path = f'{paths[0]}.tmp'
+        torch.save(data, tmp_path)
+        for path in paths[1:]:
+            shutil.copyfile(tmp_path, f'{path}.tmp')
+            os.replace(f'{path}.tmp', path)
+        os.replace(tmp_path, paths[0])
+
+        for path in paths:
+            Checkpoint.__write_header(header, path)
+
+    @staticmethod
+    def __write_header(header, path):
+        header_path = Checkpoint.header_path(path)
+        with open(f'{header_path}.tmp', 'w') as f:
+            json.dump(header, f, indent=2)
+        os.replace(f'{header_path}.tmp', header_path)
 
 class Config():
     def __init__(self, args):
@@ -574,28 +2336,57 @@ class Config():
         self.device_name = "cpu" if is_cpu else "cuda:0"
         self.device = torch.device(self.device_name)
 
+        # processes launched by torchrun have their ranks in environment variables
+        self.rank = int(os.environ.get('RANK', 0))
+        self.local_rank = int(os.environ.get('LOCAL_RANK', 0))
+        self.world_size = int(os.environ.get('WORLD_SIZE', args.nnodes * args.nprocs))
+
+        self.best_model_path = f'{args.dataroot}/{args.name}.best.pth'
         if args.model_path is None:
             self.model_path = f'{args.dataroot}/{args.name}.pth'
-        self.best_model_path = f'{args.dataroot}/{args.name}.best.pth'
+        elif args.eval_only:
+            # evaluate the given model instead of the best one
+            self.best_model_path = args.model_path
         self.tensorboard_log_dir = f'{args.dataroot}/runs/{args.name}'
 
+        if args.precision is None and args.fp16:
+            self.precision = 'fp16'
+
         self.start_epoch = 1
         self.last_steps = 0
+        self.epoch_batches = 0
+        self.quantized = False
         if os.path.isfile(self.model_path):
-            loaded = torch.load(self.model_path, map_location=self.device_name)
+            loaded = Checkpoint.read_header(self.model_path)
+            self.quantized = loaded.get('quantized', False)
+            if args.precision is None and not args.fp16:
+                # same precision as the loaded model unless specified
+                self.precision = loaded.get('precision', 'fp16' if loaded['fp16'] else 'fp32')
             self.__set_from_model('batch_size', loaded)
             self.__set_from_model('vocab_size', loaded)
             self.__set_from_model('n_layers', loaded)
             self.__set_from_model('n_heads', loaded)
             self.__set_from_model('n_words', loaded)
             self.__set_from_model('dim', loaded)
-            self.__set_from_model('fp16', loaded)
             self.__set_from_model('name', loaded)
             self.start_epoch = loaded['last_epoch'] + 1
             self.last_steps = loaded['last_steps']
+            self.epoch_batches = loaded.get('epoch_batches', 0)
+
+        if self.precision is None:
+            self.precision = 'fp32'
 
-        if is_cpu:
-            self.fp16 = False
+        if is_cpu and self.precision == 'fp16':
+            print('fp16 is not supported on cpu, fp32 is used instead. use --precision bf16 to speed up')
+            self.precision = 'fp32'
+
+        if (self.quantized or self.quantize) and self.precision != 'fp32':
+            print('quantized model runs with fp32')
+            self.precision = 'fp32'
+
+        assert not (self.quantized or self.quantize) or is_cpu, 'quantized model runs only on cpu'
+
+        self.fp16 = self.precision == 'fp16'
 
         for key in self.__dict__:
             print('{}: {}'.format(key, getattr(self, key)))
@@ -610,7 +2401,155 @@ class Config():
             print('{} is overwritten by loaded value {}'.format(key, loaded_value))
             setattr(self, key, loaded_value)
 
-if __name__ == '__main__':
+def init_distributed(config, local_rank):
+    """
+    joins process group of distributed training. gloo is used on cpu.
+    """
+    if 'RANK' not in os.environ:
+        config.local_rank = local_rank
+        config.rank = config.node_rank * config.nprocs + local_rank
+
+    if config.device.type == 'cuda':
+        config.device_name = f'cuda:{config.local_rank}'
+        config.device = torch.device(config.device_name)
+        torch.cuda.set_device(config.device)
+    else:
+        # share cores of the machine among processes
+        n_local = int(os.environ.get('LOCAL_WORLD_SIZE', config.nprocs))
+        torch.set_num_threads(max(1, os.cpu_count() // n_local))
+
+    dist.init_process_group(
+        'nccl' if config.device.type == 'cuda' else 'gloo',
+        init_method=f'tcp://{config.master_addr}:{config.master_port}' if 'RANK' not in os.environ else 'env://',
+        rank=config.rank,
+        world_size=config.world_size,
+        # other processes wait for master process while it evaluates
+        timeout=datetime.timedelta(hours=3),
+    )
+
+def run_distributed(local_rank, config):
+    init_distributed(config, local_rank)
+    run(config)
+    dist.destroy_process_group()
+
+def run_translation_worker(config, threads, tasks, results):
+    """
+    translates batches of token ids from tasks until None is given
+    """
+    torch.set_num_threads(threads)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            trainer = Trainer(config)
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+        return
+
+    # tells that the model is loaded
+    results.put((None, None, None))
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+
+        batch_id, sentences = task
+        try:
+            results.put((batch_id, TextTranslator.translate_batch(trainer, sentences), None))
+        except Exception:
+            results.put((batch_id, None, traceback.format_exc()))
+
+def run_evaluation_worker(config, threads, tasks, results):
+    """
+    evaluates weights from tasks until None is given
+    """
+    torch.set_num_threads(threads)
+    try:
+        with contextlib.redirect_stdout(sys.stderr):
+            trainer = Trainer(config)
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+        return
+
+    while True:
+        task = tasks.get()
+        if task is None:
+            return
+
+        epoch, encoder, decoder = task
+        try:
+            trainer.encoder.load_state_dict(encoder)
+            trainer.decoder.load_state_dict(decoder)
+            results.put((epoch, trainer.compute_metrics(), None))
+        except Exception:
+            results.put((epoch, None, traceback.format_exc()))
+
+def run(config):
+    torch.manual_seed(config.seed)
+    np.random.seed(config.seed)
+
+    if config.rank == 0:
+        os.makedirs(config.tensorboard_log_dir, exist_ok=True)
+
+    trainer = Trainer(config)
+
+    if config.export_inference is not None:
+        trainer.export_inference(config.export_inference)
+        return
+
+    if config.export_graph is not None:
+        trainer.export_graph(config.export_graph)
+        return
+
+    if config.serve:
+        TranslationServer(trainer, config).serve()
+        return
+
+    if config.translate_text:
+        input = sys.stdin if config.input is None else open(config.input, encoding='utf-8')
+        output = sys.stdout if config.output is None else open(config.output, 'w', encoding='utf-8')
+        TextTranslator(trainer, config).translate_file(input, output)
+        output.close()
+        return
+
+    if config.generate_test:
+        config.tgt = config.src
+        trainer.generate_test()
+        return
+
+    if config.eval_only:
+        for data_type in ['valid', 'test']:
+            if trainer.shortlist is not None:
+                trainer.compare_shortlist(data_type)
+            else:
+                trainer.evaluate(data_type=data_type)
+        return
+
+    for epoch in range(config.start_epoch, config.start_epoch + config.epochs):
+        trainer.train(epoch)
+
+        is_eval_epoch = epoch % config.epochs_by_eval == 0
+        if is_eval_epoch and trainer.is_master:
+            if config.async_eval:
+                trainer.evaluate_async(epoch)
+            else:
+                trainer.evaluate(epoch)
+
+        # results of background evaluation arrive in any epoch
+        if trainer.is_master:
+            trainer.collect_evaluations()
+
+        if is_eval_epoch or config.async_eval:
+            if trainer.is_early_stopping():
+                if trainer.is_master:
+                    print(f'early stopping epoch: {epoch}')
+                break
+
+    if trainer.is_master:
+        trainer.collect_evaluations(wait=True)
+        trainer.close_evaluator()
+    trainer.checkpoint.wait()
+
+def get_parser():
     parser = argparse.ArgumentParser(add_help=True)
     parser.add_argument('--cpu', action='store_true', help='use cpu')
     parser.add_argument('--dataroot', default='data', help='path to data')
@@ -618,6 +2557,15 @@ if __name__ == '__main__':
     parser.add_argument('--tgt', default='en', help='target language')
     parser.add_argument('--epochs', type=int, default=10, help='epoch count')
     parser.add_argument('--batch_size', type=int, default=2, help='size of batch')
+    parser.add_argument('--max_tokens', type=int, default=0, help='make training batches of similar length sentences up to this number of tokens instead of batch_size')
+    parser.add_argument('--update_freq', type=int, default=1, help='update parameters every this number of batches accumulating gradients')
+    parser.add_argument('--tokens_per_update', type=int, default=0, help='update parameters when this number of target tokens are accumulated, update_freq is ignored if set')
+    parser.add_argument('--nprocs', type=int, default=1, help='number of training processes on this machine')
+    parser.add_argument('--nnodes', type=int, default=1, help='number of machines for distributed training')
+    parser.add_argument('--node_rank', type=int, default=0, help='rank of this machine in distributed training')
+    parser.add_argument('--master_addr', default='127.0.0.1', help='address of the machine of rank 0 in distributed training')
+    parser.add_argument('--master_port', type=int, default=29500, help='port of the machine of rank 0 in distributed training')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
     parser.add_argument('--log_interval', type=int, default=5, help='step num to display log')
     parser.add_argument('--vocab_size', type=int, default=8, help='vocabulary size for copy task')
     parser.add_argument('--n_layers', type=int, default=3, help='number of layers')
@@ -626,40 +2574,62 @@ if __name__ == '__main__':
     parser.add_argument('--dim', type=int, default=8, help='dimention of word embeddings')
     parser.add_argument('--dropout', type=int, default=0.1, help='rate of dropout')
     parser.add_argument('--warmup_steps', type=int, default=4000, help='adam lr increases until this steps have passed')
+    parser.add_argument('--profile', action='store_true', help='record profile of updates with torch profiler to tensorboard log')
+    parser.add_argument('--profile_steps', type=int, default=5, help='number of updates recorded by --profile after 3 updates of warmup')
+    parser.add_argument('--save_interval', type=int, default=0, help='save model every this number of updates to resume in the middle of epoch')
     parser.add_argument('--generate_test', action='store_true', help='only generate translated sentences')
+    parser.add_argument('--binarize', action='store_true', help='convert id text files in dataroot to binary files opened with memory map')
+    parser.add_argument('--export_inference', default=None, help='save weights and hyperparameters only to this path for inference')
+    parser.add_argument('--quantize', action='store_true', help='quantize linear layers to int8 in --export_inference')
+    parser.add_argument('--export_graph', default=None, help='export encoder and a decoder step as TorchScript graphs to this directory for translate_exported.py')
+    parser.add_argument('--translate_text', action='store_true', help='translate raw text lines with sentencepiece model given by --spm_model')
+    parser.add_argument('--spm_model', default=None, help='sentencepiece model to tokenize and detokenize in --translate_text')
+    parser.add_argument('--input', default=None, help='text file translated by --translate_text, stdin is read if not given')
+    parser.add_argument('--output', default=None, help='file translations are written to by --translate_text, stdout is used if not given')
+    parser.add_argument('--workers', type=int, default=1, help='number of processes translating batches in --translate_text')
+    parser.add_argument('--threads_per_worker', type=int, default=None, help='number of threads torch uses in each worker, cpu count divided by workers if not given')
+    parser.add_argument('--chunk_size', type=int, default=10000, help='number of lines read and translated at a time in --translate_text')
+    parser.add_argument('--serve', action='store_true', help='run http server that translates requested sentences of token ids')
+    parser.add_argument('--translation_cache_size', type=int, default=0, help='number of generated sentences kept in memory to return them for the same sources, 0 disables')
+    parser.add_argument('--translation_cache_db', default=None, help='sqlite file generated sentences are also kept in across restarts')
+    parser.add_argument('--host', default='127.0.0.1', help='host the server listens on')
+    parser.add_argument('--port', type=int, default=8000, help='port the server listens on')
+    parser.add_argument('--max_batch_size', type=int, default=32, help='max number of sentences the server translates at once')
+    parser.add_argument('--max_latency_ms', type=float, default=10, help='time the server waits from the first request for others to be batched together')
     parser.add_argument('--train_test', action='store_true', help='training copy task with random value')
     parser.add_argument('--eval_only', action='store_true', help='execute evaluation only')
     parser.add_argument('--epochs_by_eval', type=int, default=5, help='evaluate by every this epochs ')
-    parser.add_argument('--fp16', action='store_true', help='run model with float16')
+    parser.add_argument('--async_eval', action='store_true', help='evaluate snapshot of weights in background process while training goes on')
+    parser.add_argument('--eval_threads', type=int, default=None, help='number of threads of background evaluation, a quarter of cpus by default')
+    parser.add_argument('--fp16', action='store_true', help='run model with float16, same as --precision fp16')
+    parser.add_argument('--precision', default=None, choices=['fp32', 'bf16', 'fp16'], help='precision of autocast, bf16 also works on cpu. same as loaded model if not specified')
     parser.add_argument('--name', default='default', help='name of training, used to model name, log dir name etc')
     parser.add_argument('--early_stopping_threshold', type=int, default=3, help='evaluation count to early stopping')
     parser.add_argument('--model_path', default=None, help='model path')
+    parser.add_argument('--attention_impl', default='reference', choices=MultiHeadAttention.IMPLS, help='reference: matmul and softmax, fused: fused key/value projection and scaled_dot_product_attention, chunked: attend chunks of queries not to hold whole score matrix')
+    parser.add_argument('--attention_chunk_size', type=int, default=64, help='number of queries attended at a time by chunked attention')
+    parser.add_argument('--checkpoint_layers', type=int, default=0, help='activations of every this number of layers are recomputed in backward to save memory in training, 0 disables it')
+    parser.add_argument('--beam_size', type=int, default=1, help='beam size for generation, greedy search is used when 1')
+    parser.add_argument('--max_len_a', type=float, default=1.5, help='generated length is bounded by max_len_a * source length + max_len_b')
+    parser.add_argument('--max_len_b', type=int, default=10, help='generated length is bounded by max_len_a * source length + max_len_b')
+    parser.add_argument('--shortlist', type=int, default=0, help='words are generated only from this number of candidates of each source word and frequent words, 0 uses full vocabulary')
+    parser.add_argument('--shortlist_frequent', type=int, default=100, help='number of the most frequent target words always in shortlist')
+    parser.add_argument('--length_penalty', type=float, default=1.0, help='hypothesis scores are divided by length ** length_penalty in beam search')
+    return parser
+
+if __name__ == '__main__':
+    parser = get_parser()
     args = parser.parse_args()
 
     config = Config(args)
 
-    os.makedirs(config.tensorboard_log_dir, exist_ok=True)
-
-    trainer = Trainer(config)
-
-    if config.generate_test:
-        config.tgt = config.src
-        trainer.generate_test()
-        sys.exit()
-
-    if config.eval_only:
-        trainer.evaluate(data_type='valid')
-        trainer.evaluate(data_type='test')
+    if config.binarize:
+        MTDataset.binarize(config)
         sys.exit()
 
-    for epoch in range(config.start_epoch, config.start_epoch + config.epochs):
-        trainer.train()
-
-        if epoch % config.epochs_by_eval == 0:
-            trainer.evaluate(epoch)
-
-            if trainer.is_early_stopping():
-                print(f'early stopping epoch: {epoch}')
-                break
-
-
+    if 'RANK' in os.environ:
+        run_distributed(config.local_rank, config)
+    elif 1 < config.world_size:
+        mp.spawn(run_distributed, args=(config,), nprocs=config.nprocs)
+    else:
+        run(config)
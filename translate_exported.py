@@ -0,0 +1,116 @@
+import sys
+import json
+import argparse
+
+import torch
+
+class ExportedTranslator(object):
+    """
+    greedy decoding over graphs exported by transformer.py --export_graph,
+    only torch is required, model classes and their config are not.
+    """
+    def __init__(self, graph_dir, device='cpu'):
+        with open(f'{graph_dir}/graph.json') as f:
+            self.meta = json.load(f)
+
+        self.device = torch.device(device)
+        self.encoder = torch.jit.load(f'{graph_dir}/encoder.pt', map_location=self.device)
+        self.decoder_step = torch.jit.load(f'{graph_dir}/decoder_step.pt', map_location=self.device)
+
+    def get_max_len(self, x):
+        """
+        generated length including BOS, same as the one of the model generating
+        """
+        src_len = (x != self.meta['pad_id']).sum(dim=1).max().item()
+        max_len = int(self.meta['max_len_a'] * src_len + self.meta['max_len_b'])
+        return max(2, min(self.meta['n_words'], max_len))
+
+    @torch.no_grad()
+    def translate(self, x):
+        """
+        x is a batch of source sentences padded with pad_id,
+        returns generated sentences starting with bos_id
+        """
+        meta = self.meta
+        x = x.to(self.device)
+        max_len = self.get_max_len(x)
+        src_mask, src_k, src_v = self.encoder(x)
+
+        batch_size, _ = x.shape
+        output = torch.full((batch_size, max_len), meta['pad_id'], dtype=torch.long, device=self.device)
+        output[:, 0] = meta['bos_id']
+
+        generated = output.clone()
+        sent_ids = torch.arange(batch_size, device=self.device)
+
+        dim_per_head = meta['dim'] // meta['n_heads']
+        k = torch.zeros(meta['n_layers'], batch_size, meta['n_heads'], 0, dim_per_head, dtype=src_k.dtype, device=self.device)
+        v = torch.zeros_like(k)
+        pad_mask = torch.zeros(batch_size, 0, dtype=torch.bool, device=self.device)
+
+        for i in range(1, max_len):
+            position = torch.tensor([i - 1], device=self.device)
+            log_probs, k, v, pad_mask = self.decoder_step(generated[:, i-1:i], position, src_mask, src_k, src_v, k, v, pad_mask)
+            _, next_words = torch.max(log_probs, dim=1)
+
+            generated[:, i] = next_words
+
+            is_finished = next_words == meta['eos_id']
+            if i == max_len - 1 or not is_finished.any():
+                continue
+
+            output[sent_ids[is_finished], :i+1] = generated[is_finished, :i+1]
+
+            # finished sentences are removed with their cache
+            alive = ~is_finished
+            if not alive.any():
+                break
+
+            sent_ids = sent_ids[alive]
+            generated = generated[alive]
+            src_mask = src_mask[alive]
+            src_k, src_v = src_k[:, alive], src_v[:, alive]
+            k, v = k[:, alive], v[:, alive]
+            pad_mask = pad_mask[alive]
+
+        output[sent_ids] = generated
+
+        return output.to(dtype=torch.int)
+
+    def strip(self, ids):
+        """
+        removes bos_id and ids from eos_id
+        """
+        ids = ids[1:]
+        for i, id in enumerate(ids):
+            if id == self.meta['eos_id'] or id == self.meta['pad_id']:
+                return ids[:i]
+
+        return ids
+
+def read_batches(lines, batch_size, pad_id):
+    batch = []
+    for line in lines:
+        batch.append(torch.tensor([int(id) for id in line.split()], dtype=torch.long))
+        if len(batch) == batch_size:
+            yield torch.nn.utils.rnn.pad_sequence(batch, batch_first=True, padding_value=pad_id)
+            batch = []
+
+    if 0 < len(batch):
+        yield torch.nn.utils.rnn.pad_sequence(batch, batch_first=True, padding_value=pad_id)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(add_help=True)
+    parser.add_argument('graph_dir', help='directory graphs are exported to by transformer.py --export_graph')
+    parser.add_argument('--input', default=None, help='file of source sentences, a line of token ids per sentence. stdin is read if not given')
+    parser.add_argument('--batch_size', type=int, default=32, help='number of sentences translated together')
+    args = parser.parse_args()
+
+    translator = ExportedTranslator(args.graph_dir)
+
+    lines = sys.stdin if args.input is None else open(args.input)
+    lines = (line for line in lines if line.strip() != '')
+
+    for x in read_batches(lines, args.batch_size, translator.meta['pad_id']):
+        for ids in translator.translate(x).tolist():
+            print(' '.join([str(id) for id in translator.strip(ids)]))